@@ -11,6 +11,7 @@ if not settings.configured:
             },
         },
         INSTALLED_APPS=(
+            'django.contrib.admin',
             'django.contrib.auth',
             'django.contrib.contenttypes',
             'django.contrib.sessions',
@@ -28,10 +29,28 @@ if not settings.configured:
             'django.contrib.sessions.middleware.SessionMiddleware',
             'django.contrib.auth.middleware.AuthenticationMiddleware',
         ),
-        ROOT_URLCONF=None,
+        MIDDLEWARE=(
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+            'django.contrib.messages.middleware.MessageMiddleware',
+        ),
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'APP_DIRS': True,
+            'OPTIONS': {
+                'context_processors': [
+                    'django.template.context_processors.request',
+                    'django.contrib.auth.context_processors.auth',
+                    'django.contrib.messages.context_processors.messages',
+                ],
+            },
+        }],
+        ROOT_URLCONF='tests.urls',
+        STATIC_URL='/static/',
         USE_TZ=True,
         SECRET_KEY='foobar',
-        # SILENCED_SYSTEM_CHECKS=['1_7.W001'],
+        # the tests run in a single process
+        SILENCED_SYSTEM_CHECKS=['workflow_activity.W001'],
     )
 
 
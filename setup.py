@@ -35,6 +35,7 @@ setup(
     version = "1.2.0",
     packages = find_packages(exclude=["*.tests", "*.tests.*", "tests.*", "tests"]),
 
+    python_requires='>=3.6',
     install_requires=libraries,
     dependency_links=dependency_links,
     include_package_data=True,
@@ -51,7 +52,14 @@ setup(
                    'Intended Audience :: Developers',
                    'Natural Language :: English',
                    'Operating System :: POSIX :: Linux',
-                   'Programming Language :: Python :: 2.7',
+                   'Framework :: Django :: 3.2',
+                   'Programming Language :: Python :: 3',
+                   'Programming Language :: Python :: 3 :: Only',
+                   'Programming Language :: Python :: 3.6',
+                   'Programming Language :: Python :: 3.7',
+                   'Programming Language :: Python :: 3.8',
+                   'Programming Language :: Python :: 3.9',
+                   'Programming Language :: Python :: 3.10',
                    'Topic :: Internet :: WWW/HTTP :: WSGI :: Application',
     ],
 
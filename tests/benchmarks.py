@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the workflow_activity application. They are run against an
+in-memory SQLite database and print their results as JSON : ::
+
+    python -m tests.benchmarks --sizes 1000 100000 1000000
+
+Each benchmark is run for every number of ``FlatPage`` instances, the tables
+only grow between two sizes. The results of two commits can be compared with
+``--output`` : ::
+
+    python -m tests.benchmarks --output before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import sys
+import time
+
+import runtests  # noqa: configures the settings
+import django
+
+
+REPEAT = 50
+ACTIONS_PER_OBJECT = 2
+# one instance out of ENDED_EVERY is in the ending state
+ENDED_EVERY = 10
+BATCH_SIZE = 10000
+PAGE_SIZE = 100
+
+
+def measure(func, repeat=REPEAT):
+    """ Run a function several times
+
+    :return: the median wall time of a run in seconds and the number of
+        queries of a run
+    :rtype: a dict
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+    return {
+        'seconds': sorted(timings)[len(timings) // 2],
+        'queries': len(queries),
+    }
+
+
+class Fixture(object):
+    """ Holds the workflow created by ``workflows.tests.create_workflow``,
+    with an ending state and a publisher allowed to edit the private
+    instances
+    """
+
+    def __init__(self):
+        from workflows.tests import create_workflow
+        from workflows.models import State
+        from workflows.models import StatePermissionRelation
+        from workflows.models import Transition
+        from workflows.models import WorkflowPermissionRelation
+        from django.contrib.auth.models import User
+        from django.contrib.contenttypes.models import ContentType
+        import permissions.utils
+        from .models import FlatPage
+
+        create_workflow(self)
+        self.edit = permissions.utils.register_permission('Edit', 'edit')
+        self.publisher = permissions.utils.register_role('Publisher')
+        self.rejected = State.objects.create(name='Rejected', workflow=self.w)
+        self.reject = Transition.objects.create(name='Reject',
+            workflow=self.w, destination=self.rejected, permission=self.edit)
+        self.private.transitions.add(self.reject)
+        WorkflowPermissionRelation.objects.create(workflow=self.w,
+            permission=self.edit)
+        StatePermissionRelation.objects.create(state=self.private,
+            permission=self.edit, role=self.publisher)
+
+        self.user = User.objects.create(username='benchmark_user')
+        permissions.utils.add_role(self.user, self.publisher)
+        self.ctype = ContentType.objects.get_for_model(FlatPage)
+        self.size = 0
+
+    def grow(self, size):
+        """ Insert instances, with their state, permissions and actions,
+        until there are ``size`` instances """
+        from workflows.models import StateObjectRelation
+        from workflow_activity.models import Action
+        from workflow_activity.utils import update_permissions_for_objects
+        from .models import FlatPage
+
+        while self.size < size:
+            batch = range(self.size + 1,
+                min(self.size + BATCH_SIZE, size) + 1)
+            FlatPage.objects.bulk_create([
+                FlatPage(pk=pk, url='/page-{0}'.format(pk), title='Page')
+                for pk in batch
+            ])
+            states = dict((pk, self.rejected if pk % ENDED_EVERY == 0
+                else self.private) for pk in batch)
+            StateObjectRelation.objects.bulk_create([
+                StateObjectRelation(content_type=self.ctype, content_id=pk,
+                    state=state)
+                for pk, state in states.items()
+            ])
+            for state in (self.private, self.rejected):
+                update_permissions_for_objects(self.ctype, [pk for pk in batch
+                    if states[pk] == state], state)
+            Action.objects.bulk_create([
+                Action(content_type=self.ctype, object_id=pk,
+                    actor=self.user, workflow=self.w,
+                    transition=self.make_public, previous_state=self.private)
+                for pk in batch for _ in range(ACTIONS_PER_OBJECT)
+            ])
+            self.size = batch[-1]
+
+    def instance(self, pk=None):
+        """ A fresh instance, without any cache, in the middle of the table
+        """
+        from .models import FlatPage
+
+        pk = pk or self.size // 2 + 1
+        return FlatPage(pk=pk, url='/page-{0}'.format(pk), title='Page')
+
+
+def bench_change_state(fixture, size):
+    """ Change the state of an instance back and forth """
+    instance = fixture.instance(pk=1)
+    transitions = itertools.cycle([fixture.make_public, fixture.make_private])
+    return {
+        'change_state': measure(
+            lambda: instance.change_state(next(transitions), fixture.user)),
+    }
+
+
+def bench_allowed_transitions(fixture, size):
+    """ Allowed transitions and permissions of an instance, on a fresh
+    instance and on an instance that already resolved them """
+    warm = fixture.instance()
+    warm.allowed_transitions(fixture.user)
+    return {
+        'allowed_transitions': measure(lambda: fixture.instance()
+            .allowed_transitions(fixture.user)),
+        'allowed_transitions_cached': measure(
+            lambda: warm.allowed_transitions(fixture.user)),
+        'is_editable_by': measure(lambda: fixture.instance()
+            .is_editable_by(fixture.user)),
+    }
+
+
+def bench_action_lookups(fixture, size):
+    """ Latest action of an instance and latest actions of an actor """
+    from workflow_activity.models import Action
+
+    instance_history = Action.objects.filter(content_type=fixture.ctype,
+        object_id=size // 2 + 1)
+    actor_history = Action.objects.filter(actor=fixture.user)\
+        .order_by('-process_date')
+    return {
+        'last_action': measure(lambda: fixture.instance().last_action()),
+        'actor_history': measure(lambda: list(actor_history[:20])),
+        'last_action_plan': query_plan(
+            instance_history.order_by('-process_date')[:1]),
+    }
+
+
+def bench_querysets(fixture, size):
+    """ A page of the pending, ended and editable instances """
+    from .models import FlatPage
+
+    return {
+        'pending': measure(lambda: list(FlatPage.pending.all()[:PAGE_SIZE])),
+        'ended': measure(lambda: list(FlatPage.ended.all()[:PAGE_SIZE])),
+        'editable_by_roles': measure(lambda: list(FlatPage.pending
+            .editable_by_roles([fixture.publisher])[:PAGE_SIZE])),
+        'editable_by_user': measure(lambda: list(FlatPage.pending
+            .editable_by_user(fixture.user)[:PAGE_SIZE])),
+        'pending_count': measure(lambda: FlatPage.pending.count(), repeat=5),
+    }
+
+
+def query_plan(queryset):
+    """ The query plan of the database for a queryset """
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+BENCHMARKS = [
+    bench_change_state,
+    bench_allowed_transitions,
+    bench_action_lookups,
+    bench_querysets,
+]
+
+
+def run(sizes, drop_indexes=False, benchmarks=None):
+    """ Run the benchmarks for each size
+
+    :param sizes: the numbers of workflow managed instances
+    :type sizes: list of integers
+    :param drop_indexes: run without the indexes of the action table
+    :type drop_indexes: a boolean
+    :param benchmarks: the names of the benchmarks to run, all if not given
+    :type benchmarks: list of strings
+    :return: the results of the benchmarks
+    :rtype: a list of dicts
+    """
+    from django.db import connection
+    from workflow_activity.models import Action
+
+    connection.creation.create_test_db(verbosity=0)
+    if drop_indexes:
+        with connection.schema_editor() as schema_editor:
+            for index in Action._meta.indexes:
+                schema_editor.remove_index(Action, index)
+
+    fixture = Fixture()
+    results = []
+    for size in sorted(sizes):
+        fixture.grow(size)
+        for benchmark in BENCHMARKS:
+            if benchmarks and benchmark.__name__ not in benchmarks:
+                continue
+            results.append({
+                'benchmark': benchmark.__name__,
+                'size': size,
+                'results': benchmark(fixture, size),
+            })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[1000, 100000, 1000000],
+        help='numbers of workflow managed instances')
+    parser.add_argument('--benchmark', action='append',
+        choices=[benchmark.__name__ for benchmark in BENCHMARKS],
+        help='run only this benchmark, can be repeated')
+    parser.add_argument('--drop-indexes', action='store_true',
+        help='run without the indexes of the action table')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+        default=sys.stdout, help='file to write the JSON results to')
+    args = parser.parse_args(argv)
+
+    django.setup()
+    results = run(args.sizes, drop_indexes=args.drop_indexes,
+        benchmarks=args.benchmark)
+    json.dump({
+        'django': django.get_version(),
+        'python': sys.version.split()[0],
+        'results': results,
+    }, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
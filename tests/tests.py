@@ -3,11 +3,35 @@
 """
 """
 
+import datetime
+import gzip
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
+
+from django.apps import apps as django_apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import RequestFactory
 from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 import permissions
 from workflows.tests import create_workflow
+from workflows.utils import set_state
 from workflows.utils import set_workflow
 from workflows.models import State
 from workflows.models import StatePermissionRelation
@@ -15,10 +39,29 @@ from workflows.models import Transition
 from workflows.models import Workflow
 from workflows.models import WorkflowPermissionRelation
 
+from workflow_activity.checks import check_shared_cache
+from workflow_activity.exceptions import StateConflict
+from workflow_activity import instrumentation
+from workflow_activity.instrumentation import QueryInstrumentationMiddleware
+from workflow_activity.instrumentation import QueryRecorder
+from workflow_activity.instrumentation import assert_query_budget
+from workflow_activity.metrics import registry
 from workflow_activity.models import Action
+from workflow_activity.models import ArchivedAction
+from workflow_activity.models import StateCounter
+from workflow_activity.models import StateDuration
 from workflow_activity.models import WorkflowManagedInstance
+from workflow_activity.models import bulk_changed_state
 from workflow_activity.models import changed_state
+from workflow_activity import _WORKFLOW_CATALOG
+from workflow_activity.admin import EstimatedCountPaginator
+from workflow_activity import _WORKFLOW_GRAPHS
 from workflow_activity.utils import get_ending_states
+from workflow_activity.utils import get_pending_state_ids
+from workflow_activity.utils import get_workflow_graph
+from workflow_activity.utils import get_workflow_ids
+from workflow_activity.utils import revalidate_workflow_graphs
+from workflow_activity.utils import seconds_between
 
 from .models import FlatPage
 
@@ -166,12 +209,107 @@ class WorkflowManagedInstanceTest(TestCase):
                 self.test_user)
         self.assertIsNone(result)
 
+    def test_allowed_transitions_without_query(self):
+        """
+        """
+        self.flat_page.allowed_transitions(self.test_user)
+        with self.assertNumQueries(0):
+            result = self.flat_page.allowed_transitions(self.test_user)
+            self.assertListEqual(result, [self.make_public, self.reject])
+            self.assertEqual(self.flat_page.allowed_transition(
+                self.reject.id, self.test_user), self.reject)
+            self.assertIsNone(self.flat_page.allowed_transition(
+                self.make_private.id, self.test_user))
+            self.assertTrue(self.flat_page.is_editable_by(self.test_user))
+
+        # permissions are resolved again after a change of state
+        self.flat_page.change_state(self.make_public, self.test_user)
+        self.assertListEqual(
+            self.flat_page.allowed_transitions(self.test_user), [])
+        self.assertFalse(self.flat_page.is_editable_by(self.test_user))
+
+    async def test_async_api(self):
+        """
+        """
+        self.assertEqual(await self.flat_page.astate(), self.private)
+        result = await self.flat_page.aallowed_transitions(self.test_user)
+        self.assertListEqual(result, [self.make_public, self.reject])
+        # resolved on the instance, no query from the event loop
+        result = await self.flat_page.aallowed_transitions(self.test_user)
+        self.assertListEqual(result, [self.make_public, self.reject])
+
+        await self.flat_page.achange_state(self.make_public, self.test_user)
+        self.assertEqual(await self.flat_page.astate(), self.public)
+        action = await self.flat_page.alast_action()
+        self.assertEqual((action.transition, action.actor),
+            (self.make_public, self.test_user))
+
+    async def test_async_iteration(self):
+        """
+        """
+        self.assertListEqual([page async for page in FlatPage.pending.all()],
+            [self.flat_page])
+        self.assertListEqual([page async for page in FlatPage.ended.all()],
+            [])
+
+    def test_allowed_transitions_superuser(self):
+        """
+        """
+        superuser = User.objects.create(username='admin', is_superuser=True)
+        self.flat_page.state
+        get_workflow_graph(self.w)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                len(self.flat_page.allowed_transitions(superuser)), 2)
+            self.assertTrue(self.flat_page.is_editable_by(superuser))
+
+    def test_allowed_transitions_bulk(self):
+        """
+        """
+        second_page = FlatPage.objects.create(url='/page-2', title='Page 2')
+        third_page = FlatPage.objects.create(url='/page-3', title='Page 3')
+        fourth_page = FlatPage.objects.create(url='/page-4', title='Page 4')
+        set_workflow(second_page, self.w)
+        set_workflow(third_page, self.w)
+        third_page.change_state(self.make_public, self.test_user)
+        pages = [self.flat_page, second_page, third_page, fourth_page]
+        get_workflow_graph(self.w)
+
+        # a local role only for the second page
+        permissions.utils.add_local_role(second_page, self.anonymous_user,
+            self.publisher)
+
+        with self.assertNumQueries(3):
+            result = FlatPage.allowed_transitions_bulk(pages, self.test_user)
+        self.assertDictEqual(result, {
+            self.flat_page.pk: [self.make_public, self.reject],
+            second_page.pk: [self.make_public, self.reject],
+            third_page.pk: [],
+            fourth_page.pk: [],
+        })
+        with self.assertNumQueries(0):
+            self.assertTrue(second_page.is_editable_by(self.test_user))
+
+        # the queryset itself is evaluated
+        with self.assertNumQueries(4):
+            result = FlatPage.objects.filter(pk__in=[p.pk for p in pages])\
+                .allowed_transitions(self.anonymous_user)
+        self.assertDictEqual(result, {
+            self.flat_page.pk: [],
+            second_page.pk: [self.make_public, self.reject],
+            third_page.pk: [],
+            fourth_page.pk: [],
+        })
+        for page in pages:
+            self.assertListEqual(result[page.pk],
+                page.allowed_transitions(self.anonymous_user))
+
     def test_create_actions(self):
         """
         """
         self.flat_page.change_state(self.make_public, self.test_user)
 
-        actions = self.flat_page.actions.all()
+        actions = self.flat_page.actions.order_by('process_date', 'pk')
         self.assertEqual(actions.count(), 1)
 
         self.flat_page.change_state(self.make_private, self.test_user)
@@ -253,6 +391,53 @@ class WorkflowManagedInstanceTest(TestCase):
 
         result = FlatPage.pending.editable_by_roles([self.publisher])
         self.assertListEqual(list(result), [third_page])
+
+    def test_editable_by_roles_without_duplicates(self):
+        """
+        """
+        editor = permissions.utils.register_role('Editor')
+        StatePermissionRelation.objects.create(state=self.private,
+                permission=self.edit, role=editor)
+        result = FlatPage.pending.editable_by_roles([self.publisher, editor])
+        self.assertListEqual(list(result), [self.flat_page])
+        self.assertEqual(result.count(), 1)
+
+    def test_editable_by_user(self):
+        """
+        """
+        second_page = FlatPage.objects.create(url='/page-2', title='Page 2')
+        third_page = FlatPage.objects.create(url='/page-3', title='Page 3')
+        set_workflow(second_page, self.w)
+        set_workflow(third_page, self.w)
+        third_page.change_state(self.make_public, self.test_user)
+
+        result = FlatPage.pending.editable_by_user(self.test_user)
+        self.assertListEqual(list(result), [self.flat_page, second_page])
+        self.assertListEqual(list(FlatPage.pending.editable_by_user(
+            self.test_user, permission='view')),
+            [self.flat_page, second_page, third_page])
+        self.assertListEqual(list(
+            FlatPage.pending.editable_by_user(self.anonymous_user)), [])
+
+        # role given through a group
+        group = permissions.utils.register_group('Editors')
+        self.anonymous_user.groups.add(group)
+        permissions.utils.add_local_role(second_page, group, self.publisher)
+        self.assertListEqual(list(
+            FlatPage.pending.editable_by_user(self.anonymous_user)),
+            [second_page])
+
+        # local role of the user
+        permissions.utils.add_local_role(self.flat_page, self.anonymous_user,
+            self.publisher)
+        with self.assertNumQueries(1):
+            self.assertListEqual(list(
+                FlatPage.pending.editable_by_user(self.anonymous_user)),
+                [self.flat_page, second_page])
+
+        superuser = User.objects.create(username='admin', is_superuser=True)
+        self.assertEqual(
+            FlatPage.pending.editable_by_user(superuser).count(), 3)
         
 
 class WorkflowInstanceManager(TestCase):
@@ -287,6 +472,69 @@ class WorkflowInstanceManager(TestCase):
         self.fourth_page.delete()
         self.fifth_page.delete()
 
+    def test_with_state(self):
+        set_workflow(self.first_page, self.w)
+        set_workflow(self.second_page, self.w)
+        self.first_page.change_state(self.make_public, self.user)
+
+        with self.assertNumQueries(2):
+            result = list(FlatPage.objects.with_state())
+            self.assertListEqual([page.state for page in result],
+                [self.public, self.private, None, None, None])
+            self.assertEqual(result[0].state.workflow, self.w)
+
+        # the ending states are compiled once
+        get_pending_state_ids()
+        with self.assertNumQueries(2):
+            result = list(FlatPage.pending.with_state().by_state('Private'))
+            self.assertListEqual(result, [self.second_page])
+            self.assertEqual(result[0].state, self.private)
+
+        self.second_page.change_state(self.reject, self.user)
+        with self.assertNumQueries(2):
+            result = list(FlatPage.ended.with_state())
+            self.assertListEqual(result, [self.second_page])
+            self.assertEqual(result[0].state, self.rejected)
+
+    def test_with_state_invalidation(self):
+        set_workflow(self.first_page, self.w)
+        page = FlatPage.objects.with_state().get(pk=self.first_page.pk)
+        page.change_state(self.make_public, self.user)
+        self.assertEqual(page.state, self.public)
+
+        page = FlatPage.objects.with_state().get(pk=self.first_page.pk)
+        set_state(page, self.private)
+        self.assertEqual(page.refresh_state(), self.private)
+
+    def test_with_last_action(self):
+        set_workflow(self.first_page, self.w)
+        set_workflow(self.second_page, self.w)
+        self.first_page.change_state(self.make_public, self.user)
+        self.first_page.change_state(self.make_private, self.user)
+        self.second_page.change_state(self.reject, self.user)
+        last_action = self.first_page.actions.latest('process_date')
+
+        with self.assertNumQueries(2):
+            result = list(FlatPage.objects.with_last_action())
+            self.assertEqual(result[0].last_action_id, last_action.pk)
+            self.assertEqual(result[0].last_actor_id, self.user.pk)
+            self.assertEqual(result[0].last_transition_id,
+                self.make_private.pk)
+            self.assertEqual(result[0].last_state_id, self.public.pk)
+            self.assertEqual(result[0].last_action(), last_action)
+            self.assertEqual(result[0].last_actor(), self.user)
+            self.assertEqual(result[0].last_transition(), self.make_private)
+            self.assertEqual(result[0].last_state(), self.public)
+            self.assertEqual(result[1].last_transition(), self.reject)
+            self.assertEqual(result[1].last_state(), self.private)
+            self.assertIsNone(result[2].last_action_id)
+            self.assertIsNone(result[2].last_actor())
+            self.assertRaises(Action.DoesNotExist, result[2].last_action)
+
+        page = FlatPage.objects.with_last_action().get(pk=self.second_page.pk)
+        page.change_state(self.make_private, self.user)
+        self.assertEqual(page.last_transition(), self.make_private)
+
     def test_by_state(self):
         set_workflow(self.first_page, self.w)
         set_workflow(self.second_page, self.w)
@@ -320,6 +568,40 @@ class WorkflowInstanceManager(TestCase):
         result = result.by_state('Private')
         self.assertListEqual(list(result), [self.third_page])
 
+    def test_managers_use_compiled_states(self):
+        set_workflow(self.first_page, self.w)
+        set_workflow(self.second_page, self.w)
+        self.second_page.change_state(self.reject, self.user)
+
+        get_pending_state_ids()
+        with self.assertNumQueries(1):
+            self.assertListEqual(list(FlatPage.pending.all()),
+                [self.first_page])
+        with self.assertNumQueries(1):
+            self.assertListEqual(list(FlatPage.ended.all()),
+                [self.second_page])
+        for manager in (FlatPage.pending, FlatPage.ended):
+            self.assertNotIn('workflows_state_transitions',
+                str(manager.all().query))
+
+        # a new workflow is taken into account
+        other = Workflow.objects.create(name='Other')
+        draft = State.objects.create(name='Draft', workflow=other)
+        archived = State.objects.create(name='Archived', workflow=other)
+        archive = Transition.objects.create(name='Archive', workflow=other,
+            destination=archived)
+        draft.transitions.add(archive)
+        set_state(self.third_page, draft)
+        set_state(self.fourth_page, archived)
+        self.assertListEqual(list(FlatPage.pending.all()),
+            [self.first_page, self.third_page])
+        self.assertListEqual(list(FlatPage.ended.all()),
+            [self.second_page, self.fourth_page])
+
+        # ending states change with the transitions
+        draft.transitions.remove(archive)
+        self.assertListEqual(list(FlatPage.pending.all()), [self.first_page])
+
     def test_ended_manager(self):
         set_workflow(self.first_page, self.w)
         set_workflow(self.second_page, self.w)
@@ -337,6 +619,447 @@ class WorkflowInstanceManager(TestCase):
         self.assertListEqual(list(result), [self.second_page])
 
 
+class LazyStateIdsTest(TestCase):
+    """
+    """
+
+    def test_querysets_built_before_workflows(self):
+        _WORKFLOW_GRAPHS.clear()
+        _WORKFLOW_CATALOG.clear()
+
+        # the state ids are resolved when the queries are run
+        with self.assertNumQueries(0):
+            pending = FlatPage.pending.all()
+            ended = FlatPage.ended.all()
+        self.assertListEqual(list(pending), [])
+        self.assertListEqual(list(ended), [])
+
+        create_workflow(self)
+        user = User.objects.create(username='test_user')
+        first_page = FlatPage.objects.create(url='/page-1', title='Page 1',
+            initializer=user)
+        second_page = FlatPage.objects.create(url='/page-2', title='Page 2',
+            initializer=user)
+        first_page.set_workflow(self.w)
+        second_page.set_workflow(self.w)
+        rejected = State.objects.create(name='Rejected', workflow=self.w)
+        reject = Transition.objects.create(name='Reject', workflow=self.w,
+            destination=rejected)
+        self.private.transitions.add(reject)
+        second_page.change_state(reject, user)
+
+        self.assertListEqual(list(pending.all()), [first_page])
+        self.assertListEqual(list(ended.all()), [second_page])
+
+
+class StateCacheTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user',
+            first_name='Test', last_name='User')
+        self.flat_page = FlatPage.objects.create(url='/page-1', title='Page 1',
+            initializer=self.user)
+
+    def test_cached_state(self):
+        """
+        """
+        set_workflow(self.flat_page, self.w)
+        self.assertEqual(self.flat_page.state, self.private)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.flat_page.state, self.private)
+
+    def test_change_state(self):
+        """
+        """
+        set_workflow(self.flat_page, self.w)
+        self.flat_page.change_state(self.make_public, self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.flat_page.state, self.public)
+
+    def test_refresh_state(self):
+        """
+        """
+        set_workflow(self.flat_page, self.w)
+        self.assertEqual(self.flat_page.state, self.private)
+        set_state(self.flat_page, self.public)
+        self.assertEqual(self.flat_page.state, self.private)
+        self.assertEqual(self.flat_page.refresh_state(), self.public)
+        self.assertEqual(self.flat_page.state, self.public)
+
+    def test_refresh_from_db(self):
+        """
+        """
+        set_workflow(self.flat_page, self.w)
+        self.assertEqual(self.flat_page.state, self.private)
+        set_state(self.flat_page, self.public)
+        self.flat_page.refresh_from_db()
+        self.assertEqual(self.flat_page.state, self.public)
+
+    def test_change_state_from_stale_state(self):
+        """
+        """
+        rejected = State.objects.create(name='Rejected', workflow=self.w)
+        reject = Transition.objects.create(name='Reject', workflow=self.w,
+            destination=rejected)
+        self.private.transitions.add(reject)
+        self.public.transitions.add(reject)
+        self.flat_page.set_workflow(self.w)
+        stale = FlatPage.objects.get(pk=self.flat_page.pk)
+        other = FlatPage.objects.get(pk=self.flat_page.pk)
+        self.assertEqual(stale.state, self.private)
+        self.assertEqual(other.state, self.private)
+        self.flat_page.change_state(self.make_public, self.user)
+
+        # the transition is executed from the actual state
+        other.change_state(reject, self.user)
+        self.assertEqual(other.state, rejected)
+        # the default mode does not check that the transition leaves it
+        stale.change_state(self.make_public, self.user)
+        self.assertEqual(stale.state, self.public)
+        self.assertEqual([(action.transition, action.previous_state)
+            for action in self.flat_page.actions.order_by('pk')],
+            [(self.make_public, self.private), (reject, self.public),
+             (self.make_public, rejected)])
+        self.assertEqual(FlatPage.counts_by_state(),
+            {self.private: 0, self.public: 1, rejected: 0})
+
+    def test_optimistic_change_state(self):
+        """
+        """
+        self.flat_page.set_workflow(self.w)
+        other = FlatPage.objects.get(pk=self.flat_page.pk)
+        self.assertEqual(other.state, self.private)
+        self.flat_page.change_state(self.make_public, self.user,
+            optimistic=True)
+        with self.assertRaises(StateConflict) as context:
+            other.change_state(self.make_public, self.user, optimistic=True)
+        self.assertEqual(context.exception.expected_state, self.private)
+        self.assertEqual(other.state, self.public)
+        self.assertEqual(self.flat_page.actions.count(), 1)
+        self.assertEqual(FlatPage.counts_by_state(),
+            {self.private: 0, self.public: 1})
+
+        # the transition must leave the state, even if it is up to date
+        with self.assertRaises(StateConflict):
+            self.flat_page.change_state(self.make_public, self.user,
+                optimistic=True)
+        self.assertEqual(self.flat_page.actions.count(), 1)
+
+    def test_optimistic_change_state_retries(self):
+        """
+        """
+        rejected = State.objects.create(name='Rejected', workflow=self.w)
+        reject = Transition.objects.create(name='Reject', workflow=self.w,
+            destination=rejected)
+        self.private.transitions.add(reject)
+        self.public.transitions.add(reject)
+        self.flat_page.set_workflow(self.w)
+        other = FlatPage.objects.get(pk=self.flat_page.pk)
+        stale = FlatPage.objects.get(pk=self.flat_page.pk)
+        self.assertEqual(other.state, self.private)
+        self.assertEqual(stale.state, self.private)
+        self.flat_page.change_state(self.make_public, self.user)
+        # the transition cannot be executed from the new state
+        with self.assertRaises(StateConflict):
+            stale.change_state(self.make_public, self.user, optimistic=True,
+                retries=1)
+        # the transition is executed again from the new state
+        other.change_state(reject, self.user, optimistic=True, retries=1)
+        self.assertEqual(other.refresh_state(), rejected)
+        self.assertEqual([(action.transition, action.previous_state)
+            for action in self.flat_page.actions.order_by('pk')],
+            [(self.make_public, self.private), (reject, self.public)])
+
+    def test_optimistic_change_state_without_actor(self):
+        """
+        """
+        rejected = State.objects.create(name='Rejected', workflow=self.w)
+        reject = Transition.objects.create(name='Reject', workflow=self.w,
+            destination=rejected)
+        self.private.transitions.add(reject)
+        self.public.transitions.add(reject)
+        self.flat_page.set_workflow(self.w)
+        stale = FlatPage.objects.get(pk=self.flat_page.pk)
+        self.assertEqual(stale.state, self.private)
+        self.flat_page.change_state(self.make_public, self.user)
+
+        with self.assertRaises(StateConflict):
+            stale.change_state(self.make_public, None, optimistic=True,
+                retries=1)
+        stale.change_state(reject, None, optimistic=True, retries=1)
+        self.assertEqual(stale.refresh_state(), rejected)
+        action = self.flat_page.actions.latest('pk')
+        self.assertEqual((action.transition, action.previous_state,
+            action.actor), (reject, self.public, None))
+
+    def test_change_state_statements(self):
+        """ The number of statements of a transition documented in the README
+        """
+        self.flat_page.set_workflow(self.w)
+        self.flat_page.change_state(self.make_public, self.user)
+        # 7 statements, the savepoint of the transaction and the savepoint
+        # of the receiver creating the action
+        with self.assertNumQueries(11):
+            with assert_query_budget({'create_action': 1}):
+                self.flat_page.change_state(self.make_private, self.user)
+        # the optimistic mode reads the transitions from the compiled graph
+        get_workflow_graph(self.w)
+        with self.assertNumQueries(11):
+            self.flat_page.change_state(self.make_public, self.user,
+                optimistic=True)
+
+    def test_set_and_remove_workflow(self):
+        """
+        """
+        self.assertIsNone(self.flat_page.state)
+        self.flat_page.set_workflow(self.w)
+        self.assertEqual(self.flat_page.state, self.private)
+        self.flat_page.remove_workflow()
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.flat_page.state)
+        self.assertIsNone(self.flat_page.refresh_state())
+
+
+class BulkChangeStateTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.publisher = permissions.utils.register_role('Publisher')
+        self.user = User.objects.create(username='test_user',
+            first_name='Test', last_name='User')
+        permissions.utils.add_role(self.user, self.publisher)
+
+        self.edit = permissions.utils.register_permission('Edit', 'edit')
+        WorkflowPermissionRelation.objects.create(workflow=self.w,
+                permission=self.edit)
+        StatePermissionRelation.objects.create(state=self.private,
+                permission=self.edit, role=self.publisher)
+
+        self.pages = [FlatPage.objects.create(url='/page-%d' % i,
+            title='Page %d' % i, initializer=self.user) for i in range(5)]
+        for page in self.pages[:4]:
+            set_workflow(page, self.w)
+
+    def _receive_signal(self, sender, **kwargs):
+        self.signals.append((sender, kwargs))
+
+    def test_change_state(self):
+        """
+        """
+        self.signals = []
+        bulk_changed_state.connect(self._receive_signal, sender=FlatPage)
+        self.addCleanup(bulk_changed_state.disconnect, self._receive_signal,
+            sender=FlatPage)
+
+        result = FlatPage.objects.filter(
+            pk__in=[p.pk for p in self.pages[1:]]).change_state(
+                self.make_public, self.user)
+        self.assertEqual(result, 3)
+
+        self.assertEqual(self.pages[0].state, self.private)
+        for page in self.pages[1:4]:
+            self.assertEqual(page.state, self.public)
+            action = page.last_action()
+            self.assertEqual(action.previous_state, self.private)
+            self.assertEqual(action.transition, self.make_public)
+            self.assertEqual(action.actor, self.user)
+            self.assertEqual(action.workflow, self.w)
+        self.assertIsNone(self.pages[4].state)
+        self.assertEqual(Action.objects.count(), 3)
+
+        self.assertEqual(len(self.signals), 1)
+        sender, kwargs = self.signals[0]
+        self.assertEqual(sender, FlatPage)
+        self.assertListEqual(kwargs['instances'], self.pages[1:4])
+        self.assertEqual(kwargs['previous_states'],
+            dict((p.pk, self.private) for p in self.pages[1:4]))
+
+    def test_permissions(self):
+        """
+        """
+        self.assertTrue(self.pages[1].is_editable_by(self.user))
+        FlatPage.bulk_change_state(self.pages[1:3], self.make_public,
+            self.user)
+        self.assertTrue(self.pages[0].is_editable_by(self.user))
+        self.assertFalse(self.pages[1].is_editable_by(self.user))
+        self.assertFalse(self.pages[2].is_editable_by(self.user))
+
+        FlatPage.objects.by_state('Public').change_state(self.make_private,
+            self.user)
+        self.pages[1].refresh_state()
+        self.pages[2].refresh_state()
+        self.assertTrue(self.pages[1].is_editable_by(self.user))
+        self.assertTrue(self.pages[2].is_editable_by(self.user))
+
+    def test_fixed_number_of_queries(self):
+        """
+        """
+        StateCounter.rebuild()
+        StateCounter.objects.create(workflow=self.w, state=self.public,
+            content_type=ContentType.objects.get_for_model(FlatPage))
+        get_workflow_graph(self.w)
+        with self.assertNumQueries(12):
+            FlatPage.bulk_change_state(self.pages[:1], self.make_public,
+                self.user)
+        with self.assertNumQueries(12):
+            FlatPage.bulk_change_state(self.pages[1:], self.make_public,
+                self.user)
+
+    def test_source_states(self):
+        """
+        """
+        FlatPage.bulk_change_state(self.pages[:1], self.make_public,
+            self.user)
+        self.assertEqual(FlatPage.objects.change_state(self.make_public,
+            self.user), 3)
+        self.assertEqual(Action.objects.filter(object_id=self.pages[0].pk)
+            .count(), 1)
+
+    def test_batches(self):
+        """
+        """
+        self.signals = []
+        bulk_changed_state.connect(self._receive_signal, sender=FlatPage)
+        self.addCleanup(bulk_changed_state.disconnect, self._receive_signal,
+            sender=FlatPage)
+        with mock.patch('workflow_activity.models.BULK_BATCH_SIZE', 3):
+            self.assertEqual(FlatPage.objects.change_state(self.make_public,
+                self.user), 4)
+        self.assertEqual([[page.pk for page in kwargs['instances']]
+            for sender, kwargs in self.signals],
+            [[page.pk for page in self.pages[:3]], [self.pages[3].pk]])
+        self.assertEqual(FlatPage.objects.by_state('Public').count(), 4)
+        self.assertEqual(Action.objects.count(), 4)
+
+    def test_no_instance(self):
+        """
+        """
+        self.assertEqual(FlatPage.objects.none().change_state(
+            self.make_public, self.user), 0)
+        self.assertEqual(Action.objects.count(), 0)
+
+
+class MigrationsTest(TestCase):
+    """
+    """
+
+    def test_no_missing_migration(self):
+        """
+        """
+        call_command('makemigrations', 'workflow_activity', check=True,
+            dry_run=True, verbosity=0)
+
+    def test_state_counters_migration(self):
+        """ The counters are filled for the instances that were already in a
+        state before the migration
+        """
+        create_workflow(self)
+        user = User.objects.create(username='test_user')
+        pages = [FlatPage.objects.create(url='/page-%d' % i,
+            title='Page %d' % i) for i in range(3)]
+        for page in pages:
+            page.set_workflow(self.w)
+        pages[0].change_state(self.make_public, user)
+        StateCounter.objects.all().delete()
+
+        migration = importlib.import_module(
+            'workflow_activity.migrations.0006_statecounter')
+        migration.count_states(django_apps, mock.Mock(connection=connection))
+        self.assertEqual(FlatPage.counts_by_state(),
+            {self.private: 2, self.public: 1})
+
+
+@override_settings(WORKFLOW_ACTIVITY_BUFFER_ACTIONS=True)
+class BufferedActionsTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user')
+        self.pages = [FlatPage.objects.create(url='/page-%d' % i,
+            title='Page %d' % i) for i in range(3)]
+        for page in self.pages:
+            set_workflow(page, self.w)
+
+    def test_flush_on_commit(self):
+        """
+        """
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.pages[0].change_state(self.make_public, self.user)
+            self.pages[1].change_state(self.make_public, self.user)
+            FlatPage.bulk_change_state(self.pages[1:], self.make_private,
+                self.user)
+            self.assertEqual(Action.objects.count(), 0)
+
+        # a query per state change, once committed
+        with self.assertNumQueries(3):
+            for callback in callbacks:
+                callback()
+        # the private pages are not changed by make_private
+        self.assertEqual(Action.objects.count(), 3)
+        self.assertEqual(self.pages[1].last_transition(), self.make_private)
+        self.assertEqual(self.pages[1].last_state(), self.public)
+
+    def test_drop_on_rollback(self):
+        """
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pages[0].change_state(self.make_public, self.user)
+            try:
+                with transaction.atomic():
+                    self.pages[1].change_state(self.make_public, self.user)
+                    raise ValueError
+            except ValueError:
+                pass
+            with transaction.atomic():
+                self.pages[2].change_state(self.make_public, self.user)
+
+        self.assertEqual(Action.objects.count(), 2)
+        self.assertEqual(self.pages[0].actions.count(), 1)
+        self.assertEqual(self.pages[1].actions.count(), 0)
+        self.assertEqual(self.pages[2].actions.count(), 1)
+
+    def test_last_savepoint_rolled_back(self):
+        """
+        """
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                self.pages[0].change_state(self.make_public, self.user)
+            self.pages[1].change_state(self.make_public, self.user)
+            try:
+                with transaction.atomic():
+                    self.pages[2].change_state(self.make_public, self.user)
+                    raise ValueError
+            except ValueError:
+                pass
+
+        with self.assertNumQueries(2):
+            for callback in callbacks:
+                callback()
+        self.assertEqual(Action.objects.count(), 2)
+        self.assertEqual(self.pages[2].actions.count(), 0)
+
+        # the next transaction gets a new buffer
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pages[2].change_state(self.make_public, self.user)
+        self.assertEqual(self.pages[2].actions.count(), 1)
+
+    @override_settings(WORKFLOW_ACTIVITY_BUFFER_ACTIONS=False)
+    def test_not_buffered(self):
+        """
+        """
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.pages[0].change_state(self.make_public, self.user)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(Action.objects.count(), 1)
+
+
 class EndingStatesTest(TestCase):
     """
     """
@@ -372,6 +1095,205 @@ class EndingStatesTest(TestCase):
         self.assertListEqual(list(get_ending_states(self.w)), [])
 
 
+class WorkflowGraphTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.rejected = State.objects.create(name='Rejected', workflow=self.w)
+        self.reject = Transition.objects.create(name='Reject',
+                workflow=self.w, destination=self.rejected)
+        self.private.transitions.add(self.reject)
+
+    def test_graph(self):
+        """
+        """
+        graph = get_workflow_graph(self.w)
+        self.assertEqual(graph.workflow_id, self.w.pk)
+        self.assertEqual(graph.state_ids, frozenset([self.private.pk,
+            self.public.pk, self.rejected.pk]))
+        self.assertEqual(graph.ending_state_ids,
+            frozenset([self.rejected.pk]))
+        self.assertEqual(graph.transition_ids(self.private.pk),
+            frozenset([self.make_public.pk, self.reject.pk]))
+        self.assertEqual(graph.transition_ids(self.rejected.pk), frozenset())
+        self.assertIs(get_workflow_graph(self.w.pk), graph)
+
+    def test_read_only(self):
+        """
+        """
+        graph = get_workflow_graph(self.w)
+        with self.assertRaises(TypeError):
+            graph.transitions[self.private.pk][self.reject.pk] = None
+        with self.assertRaises(TypeError):
+            graph.transitions[self.rejected.pk] = {}
+
+        # the callers get copies of the transitions
+        user = User.objects.create(username='admin', is_superuser=True)
+        flat_page = FlatPage.objects.create(url='/page-1', title='Page 1')
+        set_workflow(flat_page, self.w)
+        transition = flat_page.allowed_transition(self.reject.pk, user)
+        self.assertEqual(transition, self.reject)
+        transition.name = 'Changed'
+        transition.destination.name = 'Changed'
+        for transition in flat_page.allowed_transitions(user):
+            transition.name = 'Changed'
+        compiled = graph.transitions[self.private.pk][self.reject.pk]
+        self.assertEqual(compiled.name, 'Reject')
+        self.assertEqual(compiled.destination.name, 'Rejected')
+        self.assertEqual(graph.transitions[self.private.pk][
+            self.make_public.pk].name, self.make_public.name)
+
+    def test_is_editable_without_query(self):
+        """
+        """
+        flat_page = FlatPage.objects.create(url='/page-1', title='Page 1')
+        set_workflow(flat_page, self.w)
+        self.assertTrue(flat_page.is_editable)
+        with self.assertNumQueries(0):
+            self.assertTrue(flat_page.is_editable)
+
+    def test_invalidation(self):
+        """
+        """
+        get_workflow_graph(self.w)
+        self.private.transitions.remove(self.reject)
+        self.assertEqual(get_workflow_graph(self.w).ending_state_ids,
+            frozenset([self.rejected.pk]))
+        self.assertNotIn(self.reject.pk,
+            get_workflow_graph(self.w).transition_ids(self.private.pk))
+
+        self.rejected.transitions.add(self.make_private)
+        self.assertEqual(get_workflow_graph(self.w).ending_state_ids,
+            frozenset())
+
+        self.make_private.states.clear()
+        self.assertEqual(get_workflow_graph(self.w).ending_state_ids,
+            frozenset([self.public.pk, self.rejected.pk]))
+
+        self.rejected.delete()
+        self.assertEqual(get_workflow_graph(self.w).state_ids,
+            frozenset([self.private.pk, self.public.pk]))
+
+        archived = State.objects.create(name='Archived', workflow=self.w)
+        self.assertIn(archived.pk, get_workflow_graph(self.w).ending_state_ids)
+
+
+class WorkflowGraphGenerationTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        cache.clear()
+
+    def test_invalidation_shared_on_commit(self):
+        """
+        """
+        graph = get_workflow_graph(self.w)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.public.transitions.remove(self.make_private)
+        new_graph = get_workflow_graph(self.w)
+        self.assertIsNot(new_graph, graph)
+        self.assertIsNotNone(new_graph.generation)
+        self.assertNotEqual(new_graph.generation, graph.generation)
+
+    def test_revalidation(self):
+        """
+        """
+        graph = get_workflow_graph(self.w)
+        with self.assertNumQueries(0):
+            revalidate_workflow_graphs()
+        self.assertIs(get_workflow_graph(self.w), graph)
+
+        # another process changed the workflow
+        cache.set('workflow_activity:graph:%d' % self.w.pk, 'changed')
+        revalidate_workflow_graphs()
+        new_graph = get_workflow_graph(self.w)
+        self.assertIsNot(new_graph, graph)
+        self.assertEqual(new_graph.generation, 'changed')
+        revalidate_workflow_graphs()
+        self.assertIs(get_workflow_graph(self.w), new_graph)
+
+        # the generation was evicted from the cache
+        cache.clear()
+        revalidate_workflow_graphs()
+        self.assertIsNot(get_workflow_graph(self.w), new_graph)
+
+    def test_shared_cache_check(self):
+        """
+        """
+        self.assertEqual([warning.id for warning in check_shared_cache(None)],
+            ['workflow_activity.W001'])
+        with override_settings(CACHES={
+                'default': {'BACKEND':
+                    'django.core.cache.backends.locmem.LocMemCache'},
+                'shared': {'BACKEND':
+                    'django.core.cache.backends.dummy.DummyCache'}},
+                WORKFLOW_ACTIVITY_CACHE='shared'):
+            self.assertEqual([warning.id for warning in
+                check_shared_cache(None)], ['workflow_activity.W002'])
+        with override_settings(CACHES={'default': {'BACKEND':
+                'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': tempfile.gettempdir()}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+    @override_settings(WORKFLOW_ACTIVITY_REVALIDATE_INTERVAL=3600)
+    def test_lazy_revalidation(self):
+        """
+        """
+        graph = get_workflow_graph(self.w)
+        revalidate_workflow_graphs()
+        # another process changed the workflow
+        cache.set('workflow_activity:graph:%d' % self.w.pk, 'changed')
+        self.assertIs(get_workflow_graph(self.w), graph)
+
+        # the graph is revalidated once the interval elapsed
+        monotonic = time.monotonic() + 3600
+        with mock.patch('workflow_activity.utils.time.monotonic',
+                return_value=monotonic):
+            new_graph = get_workflow_graph(self.w)
+        self.assertIsNot(new_graph, graph)
+        self.assertEqual(new_graph.generation, 'changed')
+
+    def test_permission_invalidation(self):
+        """
+        """
+        other = Workflow.objects.create(name='Other')
+        archived = State.objects.create(name='Archived', workflow=other)
+        Transition.objects.create(name='Archive', workflow=other,
+            destination=archived)
+        with self.assertNumQueries(1):
+            permission = permissions.models.Permission.objects.create(
+                name='Publish', codename='publish')
+        self.make_public.permission = permission
+        self.make_public.save()
+        graph = get_workflow_graph(self.w)
+        other_graph = get_workflow_graph(other)
+
+        # only the graphs of the workflows requiring the permission change
+        permission.name = 'Publish the page'
+        permission.save()
+        self.assertIs(get_workflow_graph(other), other_graph)
+        new_graph = get_workflow_graph(self.w)
+        self.assertIsNot(new_graph, graph)
+        self.assertEqual(new_graph.transitions[self.private.pk][
+            self.make_public.pk].permission.name, 'Publish the page')
+
+    def test_revalidation_of_workflow_ids(self):
+        """
+        """
+        self.assertEqual(get_workflow_ids(), frozenset([self.w.pk]))
+        # another process created a workflow
+        Workflow.objects.bulk_create([Workflow(name='Other')])
+        other = Workflow.objects.get(name='Other')
+        self.assertEqual(get_workflow_ids(), frozenset([self.w.pk]))
+        cache.set('workflow_activity:workflows', 'changed')
+        revalidate_workflow_graphs()
+        self.assertEqual(get_workflow_ids(), frozenset([self.w.pk, other.pk]))
+
+
 class StateChangedSignalsTest(TestCase):
     """
     """
@@ -405,3 +1327,705 @@ class StateChangedSignalsTest(TestCase):
         self.assertEqual(self.signal_args['previous_state'], self.private)
         self.assertEqual(self.signal_args['actor'], self.user)
         self.assertEqual(self.signal_args['transition'], self.make_public)
+
+
+class ExportWorkflowActivityTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user',
+            first_name='Test', last_name='User')
+        self.flat_page = FlatPage.objects.create(url='/page-1', title='Page 1',
+                initializer=self.user)
+        self.flat_page.set_workflow(self.w)
+        self.flat_page.change_state(self.make_public, self.user)
+        self.flat_page.change_state(self.make_private, None)
+
+    def export(self, *args, **kwargs):
+        out = StringIO()
+        call_command('export_workflow_activity', *args, stdout=out, **kwargs)
+        return out.getvalue().splitlines()
+
+    def test_csv(self):
+        lines = self.export()
+        self.assertEqual(lines[0], 'id,process_date,content_type,object_id,'
+            'workflow,transition,previous_state,actor_id,actor')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith(',tests.flatpage,1,Standard,'
+            'Make public,Private,{0},Test User'.format(self.user.pk)))
+
+    def test_jsonl(self):
+        with self.assertNumQueries(1):
+            rows = [json.loads(line) for line in self.export(format='jsonl')]
+        self.assertEqual([row['transition'] for row in rows],
+            ['Make public', 'Make private'])
+        self.assertEqual([row['actor'] for row in rows],
+            ['Test User', 'Auto'])
+        self.assertEqual(rows[1]['previous_state'], 'Public')
+
+    def test_filters(self):
+        self.assertEqual(len(self.export(format='jsonl', workflow=['Standard'],
+            content_type=['tests.flatpage'], since='2000-01-01')), 2)
+        self.assertEqual(self.export(format='jsonl',
+            workflow=[str(self.w.pk + 1)]), [])
+        self.assertEqual(self.export(format='jsonl', until='2000-01-01'), [])
+        with self.assertRaises(CommandError):
+            self.export(since='yesterday')
+        with self.assertRaises(CommandError):
+            self.export(content_type=['tests.unknown'])
+
+    def test_output_file(self):
+        self.user.first_name = u'Zoé'
+        self.user.save()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'actions.csv')
+
+        def ascii_open(file, mode='r', **kwargs):
+            # the default encoding of a non UTF-8 locale
+            kwargs.setdefault('encoding', 'ascii')
+            return open(file, mode, **kwargs)
+
+        with mock.patch('workflow_activity.management.commands.'
+                'export_workflow_activity.open', ascii_open, create=True):
+            call_command('export_workflow_activity', output=path)
+        with open(path, encoding='utf-8') as output:
+            self.assertIn(u'Zoé User', output.read())
+
+
+class ArchiveWorkflowActivityTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user',
+            first_name='Test', last_name='User')
+        self.flat_page = FlatPage.objects.create(url='/page-1', title='Page 1',
+                initializer=self.user)
+        self.flat_page.set_workflow(self.w)
+        for transition in (self.make_public, self.make_private,
+                self.make_public):
+            self.flat_page.change_state(transition, self.user)
+        self.actions = list(Action.objects.order_by('pk'))
+
+    def archive(self, *args, **kwargs):
+        out = StringIO()
+        call_command('archive_workflow_activity', *args, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def test_policy_required(self):
+        with self.assertRaises(CommandError):
+            self.archive()
+
+    def test_keep_last(self):
+        self.assertEqual(self.archive(keep_last=1, batch_size=1),
+            '2 actions archived\n')
+        self.assertEqual(list(Action.objects.all()), self.actions[2:])
+        self.assertEqual(
+            list(ArchivedAction.objects.order_by('pk')
+                .values_list('pk', 'transition')),
+            [(action.pk, action.transition_id)
+                for action in self.actions[:2]])
+
+    def test_older_than(self):
+        Action.objects.filter(pk=self.actions[0].pk).update(
+            process_date=timezone.now() - datetime.timedelta(days=10))
+        self.assertEqual(self.archive(dry_run=True, older_than=5),
+            '1 actions to archive\n')
+        self.archive(older_than=5, workflow=['Standard'])
+        self.assertEqual(list(ArchivedAction.objects.values_list('pk',
+            flat=True)), [self.actions[0].pk])
+
+    def test_jsonl(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.archive(keep_last=2, to='jsonl', directory=directory)
+        self.assertFalse(ArchivedAction.objects.exists())
+        self.assertEqual(Action.objects.count(), 2)
+        filename, = os.listdir(directory)
+        with gzip.open(os.path.join(directory, filename), 'rt') as archive:
+            row, = [json.loads(line) for line in archive]
+        self.assertEqual((row['id'], row['transition_id'], row['actor']),
+            (self.actions[0].pk, self.make_public.pk, 'Test User'))
+
+    def test_history(self):
+        self.archive(keep_last=1)
+        self.assertEqual(self.flat_page.history(), self.actions[2:])
+        history = self.flat_page.history(include_archived=True)
+        self.assertEqual([action.pk for action in history],
+            [action.pk for action in self.actions])
+        self.assertEqual([type(action) for action in history],
+            [ArchivedAction, ArchivedAction, Action])
+
+
+class QueryInstrumentationTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user',
+            first_name='Test', last_name='User')
+        self.pages = []
+        for i in range(3):
+            page = FlatPage.objects.create(url='/page-{0}'.format(i),
+                title='Page')
+            page.set_workflow(self.w)
+            page.change_state(self.make_public, self.user)
+            self.pages.append(page)
+        get_workflow_graph(self.w)
+        get_workflow_ids()
+
+    def test_recorder(self):
+        with QueryRecorder() as recorder:
+            pages = list(FlatPage.pending.all())
+            for page in pages:
+                page.last_actor()
+            pages[0].change_state(self.make_private, self.user)
+        self.assertEqual(recorder.stats['pending']['queries'], 1)
+        self.assertEqual(recorder.stats['last_action']['queries'], 3)
+        self.assertIn('create_action', recorder.stats)
+        # the queries of the action are counted for change_state too
+        self.assertGreater(recorder.stats['change_state']['queries'],
+            recorder.stats['create_action']['queries'])
+
+    def test_not_recording(self):
+        operations = []
+        def receiver(sender, **kwargs):
+            operations.extend(instrumentation._operations())
+        changed_state.connect(receiver)
+        self.addCleanup(changed_state.disconnect, receiver)
+
+        self.pages[0].change_state(self.make_private, self.user)
+        self.assertEqual(operations, [])
+
+        with QueryRecorder():
+            self.pages[1].change_state(self.make_private, self.user)
+        self.assertEqual(operations, ['change_state'])
+        self.assertEqual(instrumentation._operations(), [])
+
+    def test_budget(self):
+        with self.assertRaisesMessage(AssertionError,
+                'last_action executed 3 queries (budget 1)'):
+            with assert_query_budget({'last_action': 1}):
+                for page in FlatPage.pending.all():
+                    page.last_actor()
+
+        with assert_query_budget({'last_action': 0, 'pending': 2}):
+            for page in FlatPage.pending.with_last_action():
+                page.last_actor()
+
+    def test_middleware(self):
+        def view(request):
+            FlatPage(pk=self.pages[0].pk).allowed_transitions(self.user)
+            return HttpResponse()
+        request = RequestFactory().get('/')
+        with self.assertLogs('workflow_activity.instrumentation', 'DEBUG'):
+            QueryInstrumentationMiddleware(view)(request)
+        self.assertEqual(set(request.workflow_queries),
+            set(['state', 'allowed_transitions']))
+
+
+class MetricsTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user')
+        self.flat_page = FlatPage.objects.create(url='/page-1', title='Page 1')
+        self.flat_page.set_workflow(self.w)
+        registry.clear()
+        self.addCleanup(registry.clear)
+        self.labels = {'workflow': self.w.pk, 'transition': 'Make public',
+            'content_type': 'tests.flatpage'}
+
+    def test_change_state(self):
+        self.flat_page.change_state(self.make_public, self.user)
+        self.assertEqual(registry.value(
+            'workflow_activity_transitions_total', **self.labels), 1)
+        self.assertEqual(registry.value(
+            'workflow_activity_change_state_seconds', **self.labels), 1)
+        self.assertEqual(registry.value('workflow_activity_receivers_seconds',
+            signal='changed_state'), 1)
+
+        FlatPage.objects.all().change_state(self.make_private, self.user)
+        self.assertEqual(registry.value('workflow_activity_transitions_total',
+            workflow=self.w.pk, transition='Make private',
+            content_type='tests.flatpage'), 1)
+
+    def test_receiver_errors(self):
+        def failing_receiver(sender, **kwargs):
+            raise ValueError('failure')
+        changed_state.connect(failing_receiver)
+        self.addCleanup(changed_state.disconnect, failing_receiver)
+
+        with self.assertLogs('workflow_activity.models', 'ERROR'):
+            self.flat_page.change_state(self.make_public, self.user)
+        self.assertEqual(registry.value(
+            'workflow_activity_receiver_errors_total', signal='changed_state',
+            receiver='tests.tests.MetricsTest.test_receiver_errors.<locals>.'
+            'failing_receiver'), 1)
+        self.assertEqual(self.flat_page.actions.count(), 1)
+
+    def test_render(self):
+        self.flat_page.change_state(self.make_public, self.user)
+        text = registry.render()
+        self.assertIn('# TYPE workflow_activity_transitions_total counter\n'
+            'workflow_activity_transitions_total{{content_type='
+            '"tests.flatpage",transition="Make public",workflow="{0}"}} 1\n'
+            .format(self.w.pk), text)
+        self.assertIn('# TYPE workflow_activity_change_state_seconds '
+            'histogram\n', text)
+        self.assertIn('workflow_activity_change_state_seconds_bucket{{'
+            'content_type="tests.flatpage",transition="Make public",'
+            'workflow="{0}",le="+Inf"}} 1\n'.format(self.w.pk), text)
+
+    @override_settings(WORKFLOW_ACTIVITY_METRICS=None)
+    def test_disabled(self):
+        self.flat_page.change_state(self.make_public, self.user)
+        self.assertEqual(registry.render(), '')
+
+
+class TimeInStateTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user')
+        self.start = timezone.now() - datetime.timedelta(days=30)
+        self.pages = []
+        for i in range(2):
+            page = FlatPage.objects.create(url='/page-{0}'.format(i),
+                title='Page')
+            page.set_workflow(self.w)
+            self.pages.append(page)
+
+    def act(self, page, transition, hours):
+        """ Change the state of a page, dated some hours after the start """
+        page.change_state(transition, self.user)
+        Action.objects.filter(pk=page.actions.latest('pk').pk).update(
+            process_date=self.start + datetime.timedelta(hours=hours))
+
+    def history(self):
+        # public 1h, private 2h, public 4h for the first page, public 3h for
+        # the second one
+        self.act(self.pages[0], self.make_public, 0)
+        self.act(self.pages[0], self.make_private, 1)
+        self.act(self.pages[0], self.make_public, 3)
+        self.act(self.pages[0], self.make_private, 7)
+        self.act(self.pages[1], self.make_public, 2)
+        self.act(self.pages[1], self.make_private, 5)
+
+    def test_time_in_state(self):
+        self.history()
+        with self.assertNumQueries(2):
+            result = Action.objects.filter(workflow=self.w).time_in_state(
+                percentiles=[50, 100])
+        self.assertEqual(set(result), set([self.public, self.private]))
+        self.assertEqual(result[self.public]['count'], 3)
+        self.assertAlmostEqual(result[self.public]['average'], 8 * 3600 / 3)
+        self.assertEqual(result[self.public]['percentiles'],
+            {50: 3 * 3600, 100: 4 * 3600})
+        self.assertEqual(result[self.private]['count'], 1)
+        self.assertEqual(result[self.private]['percentiles'],
+            {50: 2 * 3600, 100: 2 * 3600})
+
+    def test_percentile_ranks(self):
+        self.history()
+        with CaptureQueriesContext(connection) as queries:
+            result = Action.objects.filter(workflow=self.w).time_in_state(
+                percentiles=[1, 34, 67, 99])
+        # the ranks are computed without a division, integer on SQLite only
+        self.assertNotIn('/ 100', queries[-1]['sql'])
+        self.assertEqual(result[self.public]['percentiles'],
+            {1: 1 * 3600, 34: 3 * 3600, 67: 4 * 3600, 99: 4 * 3600})
+
+    def test_date_range(self):
+        self.history()
+        result = Action.objects.time_in_state(
+            since=self.start + datetime.timedelta(hours=4))
+        self.assertEqual(result[self.public]['count'], 2)
+        self.assertNotIn(self.private, result)
+        self.assertEqual(Action.objects.time_in_state(
+            until=self.start + datetime.timedelta(hours=1)), {})
+
+    def test_seconds_between(self):
+        connection = mock.Mock()
+        connection.ops.subtract_temporals.return_value = ('end - start', [])
+        connection.features.has_native_duration_field = True
+        connection.vendor = 'postgresql'
+        self.assertEqual(seconds_between(connection, 'end', 'start'),
+            'EXTRACT(EPOCH FROM end - start)')
+        connection.vendor = 'oracle'
+        self.assertNotIn('EPOCH', seconds_between(connection, 'end', 'start'))
+        # the other backends take the generic path
+        connection.vendor = 'other'
+        self.assertEqual(seconds_between(connection, 'end', 'start'),
+            '(end - start) / 1000000.0')
+
+    def test_rollup(self):
+        self.act(self.pages[0], self.make_public, 0)
+        self.act(self.pages[0], self.make_private, 1)
+        self.assertEqual(StateDuration.update(), 1)
+        self.assertEqual(StateDuration.update(), 0)
+        self.act(self.pages[0], self.make_public, 3)
+        self.act(self.pages[0], self.make_private, 7)
+        self.act(self.pages[1], self.make_public, 2)
+        self.act(self.pages[1], self.make_private, 5)
+        out = StringIO()
+        call_command('rollup_workflow_activity', stdout=out)
+        self.assertEqual(out.getvalue(), '3 state durations added\n')
+
+        # the rollup is kept when the actions are archived
+        call_command('archive_workflow_activity', keep_last=0, stdout=out)
+        result = StateDuration.objects.filter(workflow=self.w).time_in_state(
+            percentiles=[50, 100])
+        self.assertEqual(result[self.public]['count'], 3)
+        self.assertEqual(result[self.public]['percentiles'],
+            {50: 3 * 3600, 100: 4 * 3600})
+        self.assertEqual(result[self.private]['percentiles'],
+            {50: 2 * 3600, 100: 2 * 3600})
+
+
+    def test_rollup_late_commit(self):
+        self.act(self.pages[0], self.make_public, 0)
+        self.act(self.pages[1], self.make_public, 2)
+        self.act(self.pages[0], self.make_private, 4.5)
+        self.act(self.pages[1], self.make_private, 5)
+        # the action of the first page is committed after the rollup
+        late = self.pages[0].actions.latest('pk')
+        late_pk = late.pk
+        late.delete()
+        self.assertEqual(StateDuration.update(), 1)
+
+        late.pk = late_pk
+        late.save(force_insert=True)
+        Action.objects.filter(pk=late.pk).update(
+            process_date=self.start + datetime.timedelta(hours=4.5))
+        self.assertEqual(StateDuration.update(), 1)
+        self.assertEqual(StateDuration.objects.get(action_id=late.pk).seconds,
+            4.5 * 3600)
+        self.assertEqual(StateDuration.update(), 0)
+
+
+class StateAtTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user')
+        self.start = timezone.now() - datetime.timedelta(days=30)
+        self.pages = []
+        for i in range(3):
+            page = FlatPage.objects.create(url='/page-{0}'.format(i),
+                title='Page')
+            page.set_workflow(self.w)
+            self.pages.append(page)
+        FlatPage.objects.update(creation_date=self.start)
+        # the first page is made public after 1 day and private after 3 days,
+        # the second public after 2 days, the third never changes
+        self.act(self.pages[0], self.make_public, 1)
+        self.act(self.pages[0], self.make_private, 3)
+        self.act(self.pages[1], self.make_public, 2)
+
+    def act(self, page, transition, days):
+        page.change_state(transition, self.user)
+        Action.objects.filter(pk=page.actions.latest('pk').pk).update(
+            process_date=self.start + datetime.timedelta(days=days))
+
+    def moment(self, days):
+        return self.start + datetime.timedelta(days=days, hours=12)
+
+    def test_state_at(self):
+        page = FlatPage.objects.get(pk=self.pages[0].pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(page.state_at(self.moment(0)), self.private)
+        self.assertEqual(page.state_at(self.moment(1)), self.public)
+        self.assertEqual(page.state_at(self.moment(3)), self.private)
+        self.assertEqual(FlatPage.objects.get(pk=self.pages[2].pk).state_at(
+            self.moment(0)), self.private)
+        self.assertIsNone(page.state_at(self.start - datetime.timedelta(1)))
+
+    def test_with_state_at(self):
+        with self.assertNumQueries(1):
+            pages = list(FlatPage.objects.with_state_at(self.moment(2))
+                .order_by('pk'))
+        self.assertEqual([page.state_at_id for page in pages],
+            [self.public.pk, self.public.pk, self.private.pk])
+        self.assertEqual([page.state_at_id for page in
+            FlatPage.objects.with_state_at(self.moment(0)).order_by('pk')],
+            [self.private.pk] * 3)
+        self.assertEqual([page.state_at_id for page in
+            FlatPage.objects.with_state_at(self.start - datetime.timedelta(1))
+            ], [None] * 3)
+        # which pages were public at a moment
+        self.assertEqual(FlatPage.objects.with_state_at(self.moment(3))
+            .filter(state_at_id=self.public.pk).get(), self.pages[1])
+
+    def test_archived_actions(self):
+        call_command('archive_workflow_activity', keep_last=1,
+            stdout=StringIO())
+        self.assertEqual(ArchivedAction.objects.count(), 1)
+        page = FlatPage.objects.get(pk=self.pages[0].pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(page.state_at(self.moment(0)), self.private)
+        self.assertEqual(page.state_at(self.moment(1)), self.public)
+        self.assertEqual(page.state_at(self.moment(3)), self.private)
+
+        call_command('archive_workflow_activity', keep_last=0,
+            stdout=StringIO())
+        self.assertEqual(Action.objects.count(), 0)
+        self.assertEqual([page.state_at_id for page in
+            FlatPage.objects.with_state_at(self.moment(2)).order_by('pk')],
+            [self.public.pk, self.public.pk, self.private.pk])
+        self.assertEqual([page.state_at_id for page in
+            FlatPage.objects.with_state_at(self.moment(0)).order_by('pk')],
+            [self.private.pk] * 3)
+
+
+class StateCounterTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user')
+        self.pages = []
+        for i in range(3):
+            page = FlatPage.objects.create(url='/page-{0}'.format(i),
+                title='Page')
+            page.set_workflow(self.w)
+            self.pages.append(page)
+
+    def test_counts_by_state(self):
+        self.assertEqual(FlatPage.counts_by_state(), {self.private: 3})
+        self.pages[0].change_state(self.make_public, self.user)
+        FlatPage.bulk_change_state(self.pages[1:], self.make_public,
+            self.user)
+        self.pages[2].change_state(self.make_private, self.user)
+        with self.assertNumQueries(1):
+            counts = FlatPage.counts_by_state(workflow=self.w)
+        self.assertEqual(counts, {self.private: 1, self.public: 2})
+        self.pages[0].remove_workflow()
+        self.assertEqual(FlatPage.counts_by_state(),
+            {self.private: 1, self.public: 1})
+
+    def test_concurrent_change(self):
+        rejected = State.objects.create(name='Rejected', workflow=self.w)
+        reject = Transition.objects.create(name='Reject', workflow=self.w,
+            destination=rejected)
+        self.public.transitions.add(reject)
+        stale = FlatPage.objects.get(pk=self.pages[0].pk)
+        self.assertEqual(stale.state, self.private)
+        self.pages[0].change_state(self.make_public, self.user)
+        # the counters are moved from the state found in the database
+        stale.change_state(reject, self.user)
+        self.assertEqual(FlatPage.counts_by_state(),
+            {self.private: 2, self.public: 0, rejected: 1})
+        self.assertEqual(StateCounter.rebuild(), 0)
+
+    def test_rolled_back(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.pages[0].change_state(self.make_public, self.user)
+                raise ValueError
+        self.assertEqual(FlatPage.counts_by_state(), {self.private: 3})
+
+    def test_rebuild(self):
+        set_state(self.pages[0], self.public)
+        StateCounter.objects.filter(state=self.private).delete()
+        out = StringIO()
+        call_command('rebuild_workflow_counters', stdout=out)
+        self.assertEqual(out.getvalue(), '2 state counters fixed\n')
+        self.assertEqual(FlatPage.counts_by_state(),
+            {self.private: 2, self.public: 1})
+        self.assertEqual(StateCounter.rebuild(), 0)
+
+
+class BulkWorkflowTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.publisher = permissions.utils.register_role('Publisher')
+        self.edit = permissions.utils.register_permission('Edit', 'edit')
+        self.user = User.objects.create(username='test_user')
+        permissions.utils.add_role(self.user, self.publisher)
+        WorkflowPermissionRelation.objects.create(workflow=self.w,
+            permission=self.edit)
+        StatePermissionRelation.objects.create(state=self.private,
+            permission=self.edit, role=self.publisher)
+        self.pages = [FlatPage.objects.create(url='/page-%d' % i,
+            title='Page %d' % i) for i in range(6)]
+
+    def test_set_workflow(self):
+        """
+        """
+        self.pages[0].set_workflow(self.w)
+        self.assertEqual(FlatPage.objects.set_workflow(self.w), 5)
+        self.assertEqual(FlatPage.objects.set_workflow(self.w), 0)
+        for page in FlatPage.objects.with_state():
+            self.assertEqual(page.state, self.private)
+            self.assertTrue(page.is_editable_by(self.user))
+        self.assertEqual(FlatPage.counts_by_state(), {self.private: 6})
+
+    def test_remove_workflow(self):
+        """
+        """
+        FlatPage.objects.set_workflow(self.w)
+        self.pages[0].change_state(self.make_public, self.user)
+        self.assertEqual(FlatPage.objects.filter(
+            pk__in=[page.pk for page in self.pages[:4]]).remove_workflow(), 4)
+        self.assertEqual(FlatPage.objects.with_state().filter(
+            state_relation__isnull=False).count(), 2)
+        self.assertEqual(FlatPage.counts_by_state(),
+            {self.private: 2, self.public: 0})
+        # the relations are already removed
+        self.pages[0].remove_workflow()
+        self.assertIsNone(self.pages[0].state)
+
+    def test_fixed_number_of_queries(self):
+        """
+        """
+        self.pages[0].set_workflow(self.w)
+        with self.assertNumQueries(13):
+            FlatPage.objects.filter(pk=self.pages[1].pk).set_workflow(self.w)
+        with self.assertNumQueries(13):
+            FlatPage.objects.set_workflow(self.w)
+        with self.assertNumQueries(7):
+            FlatPage.objects.filter(pk=self.pages[0].pk).remove_workflow()
+        with self.assertNumQueries(7):
+            FlatPage.objects.remove_workflow()
+
+
+class ActionAdminTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create_superuser('admin', 'admin@test.org',
+            'admin')
+        self.client.force_login(self.user)
+        self.other = Workflow.objects.create(name='Other')
+        self.draft = State.objects.create(name='Draft', workflow=self.other)
+        self.archived = State.objects.create(name='Archived',
+            workflow=self.other)
+        self.pages = [FlatPage.objects.create(url='/page-%d' % i,
+            title='Page %d' % i) for i in range(5)]
+        for page in self.pages:
+            page.set_workflow(self.w)
+            page.change_state(self.make_public, self.user)
+
+    def get_changelist(self, **params):
+        return self.client.get('/admin/workflow_activity/action/', params)
+
+    def test_changelist_queries(self):
+        """
+        """
+        # session, user, workflows, count, page of actions and 2 for the
+        # date hierarchy
+        with self.assertNumQueries(7):
+            response = self.get_changelist()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cl'].result_list), 5)
+
+        # the same number of queries for more actions
+        for page in self.pages:
+            page.change_state(self.make_private, self.user)
+        with self.assertNumQueries(7):
+            self.get_changelist()
+
+        # the states of the selected workflow are listed with one more query
+        with self.assertNumQueries(8):
+            self.get_changelist(workflow__id__exact=self.w.pk)
+
+    def test_workflow_filter(self):
+        """
+        """
+        # the states are not listed until a workflow is selected
+        workflow_filter, = self.get_changelist().context['cl'].filter_specs
+        self.assertListEqual(workflow_filter.lookup_choices,
+            [(self.other.pk, 'Other'), (self.w.pk, self.w.name)])
+
+    def test_previous_state_filter(self):
+        """
+        """
+        response = self.get_changelist(workflow__id__exact=self.w.pk)
+        state_filter = response.context['cl'].filter_specs[1]
+        self.assertListEqual(sorted(state_filter.lookup_choices),
+            sorted((state.pk, str(state))
+                for state in State.objects.filter(workflow=self.w)))
+
+        response = self.get_changelist(workflow__id__exact=self.other.pk)
+        state_filter = response.context['cl'].filter_specs[1]
+        self.assertListEqual(sorted(state_filter.lookup_choices),
+            [(self.draft.pk, str(self.draft)),
+             (self.archived.pk, str(self.archived))])
+
+    def test_change_form(self):
+        """
+        """
+        action = Action.objects.first()
+        response = self.client.get(
+            '/admin/workflow_activity/action/{0}/change/'.format(action.pk))
+        self.assertEqual(response.status_code, 200)
+        # the actions are a log, they are not editable
+        form = response.context['adminform'].form
+        for name in ('actor', 'transition', 'previous_state', 'workflow'):
+            self.assertNotIn(name, form.fields)
+        self.assertTrue(set(['actor_name', 'transition', 'previous_state'])
+            <= set(response.context['adminform'].readonly_fields))
+
+
+class EstimatedCountPaginatorTest(TestCase):
+    """
+    """
+
+    def setUp(self):
+        create_workflow(self)
+        self.user = User.objects.create(username='test_user')
+        page = FlatPage.objects.create(url='/page-1', title='Page 1')
+        page.set_workflow(self.w)
+        page.change_state(self.make_public, self.user)
+        page.change_state(self.make_private, self.user)
+
+    def estimate(self, reltuples):
+        """ Run the paginator as on PostgreSQL, with the planner estimating
+        the given number of rows """
+        postgresql = mock.MagicMock(vendor='postgresql')
+        postgresql.cursor.return_value.__enter__.return_value.fetchone \
+            .return_value = (reltuples, )
+        return mock.patch('workflow_activity.admin.connections',
+            {'default': postgresql})
+
+    def test_exact_count(self):
+        """
+        """
+        paginator = EstimatedCountPaginator(Action.objects.order_by('pk'), 10)
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, 2)
+
+    def test_estimated_count(self):
+        """
+        """
+        paginator = EstimatedCountPaginator(Action.objects.order_by('pk'), 10)
+        with self.estimate(250000.0):
+            self.assertEqual(paginator.count, 250000)
+
+        # small tables and filtered lists are counted exactly
+        paginator = EstimatedCountPaginator(Action.objects.order_by('pk'), 10)
+        with self.estimate(2.0):
+            self.assertEqual(paginator.count, 2)
+        paginator = EstimatedCountPaginator(
+            Action.objects.filter(transition=self.make_public).order_by('pk'),
+            10)
+        with self.estimate(250000.0):
+            self.assertEqual(paginator.count, 1)
@@ -7,4 +7,9 @@ workflow_activity
 """
 
 
-_ENDING_STATES = {}
+# compiled workflow graphs, by workflow primary key
+_WORKFLOW_GRAPHS = {}
+# primary keys of all the workflows
+_WORKFLOW_CATALOG = {}
+# monotonic time of the next revalidation of the compiled graphs
+_WORKFLOW_REVALIDATION = {}
@@ -1,4 +1,4 @@
-# -*- coding: utf-8 -*-
+# -*- coding: utf-8 -*-
 
 """
 workflow_activity.admin
@@ -9,16 +9,76 @@ Enables the admin interface for the workflow_activity application. The
 """
 
 from django.contrib import admin
-from django.utils.translation import ugettext_lazy as _
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
 
 from .models import Action
 
 
+class EstimatedCountPaginator(Paginator):
+    """ Paginator using the planner statistics of PostgreSQL instead of a
+    ``COUNT(*)`` when the whole table is listed and has more rows than
+    :py:attr:`estimate_threshold`. Other databases and filtered lists are
+    counted exactly.
+    """
+
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class '
+                    'WHERE relname = %s', [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= self.estimate_threshold:
+                return int(row[0])
+        return super(EstimatedCountPaginator, self).count
+
+
+class WorkflowListFilter(admin.RelatedFieldListFilter):
+    """ Lists the workflows with a query on their primary keys and names
+    only, instead of loading every workflow.
+    """
+
+    def field_choices(self, field, request, model_admin):
+        ordering = self.field_admin_ordering(field, request, model_admin)
+        return list(field.related_model._default_manager.order_by(
+            *(ordering or ('name', ))).values_list('pk', 'name'))
+
+
+class PreviousStateListFilter(admin.RelatedFieldListFilter):
+    """ Lists the states of the selected workflow only, instead of all the
+    states of all the workflows, with their workflow in the same query.
+    """
+
+    def field_choices(self, field, request, model_admin):
+        workflow = request.GET.get('workflow__id__exact')
+        if not workflow:
+            return []
+        states = field.related_model._default_manager.filter(
+            workflow=workflow).select_related('workflow')
+        ordering = self.field_admin_ordering(field, request, model_admin)
+        if ordering:
+            states = states.order_by(*ordering)
+        return [(state.pk, str(state)) for state in states]
+
+
 class ActionAdmin(admin.ModelAdmin):
     list_display = ('content_object_display', 'actor_name', 'workflow',
         'transition', 'previous_state', 'process_date')
     list_display_links = ('content_object_display', )
-    list_filter = ('workflow', 'previous_state')
+    list_filter = (('workflow', WorkflowListFilter),
+        ('previous_state', PreviousStateListFilter))
+    list_select_related = ('content_type', 'actor', 'workflow',
+        'transition__workflow', 'previous_state__workflow')
+    date_hierarchy = 'process_date'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     exclude = ('actor', )
     readonly_fields = ('content_type', 'object_id', 'actor_name', 'workflow',
         'transition', 'previous_state')
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+"""
+workflow_activity.apps
+======================
+
+"""
+
+from django.apps import AppConfig
+
+
+class WorkflowActivityConfig(AppConfig):
+    name = 'workflow_activity'
+
+    def ready(self):
+        from . import checks  # noqa: register the system checks
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+workflow_activity.checks
+========================
+
+System checks of the settings of the workflow_activity application.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Tags
+from django.core.checks import Warning
+from django.core.checks import register
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """ The compiled workflow graphs of each process are revalidated from the
+    cache defined by the ``WORKFLOW_ACTIVITY_CACHE`` setting, it must be
+    shared by all the processes, or the pending and ended managers of the
+    other processes miss the new states and transitions
+    """
+    alias = getattr(settings, 'WORKFLOW_ACTIVITY_CACHE', 'default')
+    backend = caches[alias]
+    if isinstance(backend, DummyCache):
+        return [Warning('The {0!r} cache stores nothing, the changes of the '
+                'workflows are never seen by the other processes.'.format(
+                    alias),
+            hint='Set WORKFLOW_ACTIVITY_CACHE to a cache shared by all the '
+                'processes (memcached, redis, database...).',
+            id='workflow_activity.W002')]
+    if isinstance(backend, LocMemCache):
+        return [Warning('The {0!r} cache is local to each process, the '
+                'changes of the workflows are not seen by the other '
+                'processes.'.format(alias),
+            hint='Set WORKFLOW_ACTIVITY_CACHE to a cache shared by all the '
+                'processes (memcached, redis, database...), unless a single '
+                'process is run.',
+            id='workflow_activity.W001')]
+    return []
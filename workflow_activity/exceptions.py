@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+"""
+workflow_activity.exceptions
+============================
+
+"""
+
+
+class StateConflict(Exception):
+    """ Raised by an optimistic
+    :py:meth:`~workflow_activity.models.WorkflowManagedInstance.change_state`
+    when the state of the instance was changed by another transaction since
+    it was read ::
+
+    .. py:attribute:: instance
+
+        The workflow managed instance
+
+    .. py:attribute:: expected_state
+
+        The state read by the instance
+
+    .. py:attribute:: transition
+
+        The transition that was not executed
+    """
+
+    def __init__(self, instance, expected_state, transition):
+        super(StateConflict, self).__init__(
+            u'The state of {0!r} is no longer {1}, {2} was not executed'
+            .format(instance, expected_state, transition.name))
+        self.instance = instance
+        self.expected_state = expected_state
+        self.transition = transition
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+workflow_activity.instrumentation
+=================================
+
+Attributes the SQL queries to the entry points of the workflow_activity
+application (``state``, ``change_state``, ``allowed_transitions``, the
+``pending`` and ``ended`` managers, ``create_action``...), to find which of
+them are run too often. ::
+
+    from workflow_activity.instrumentation import QueryRecorder
+
+    with QueryRecorder() as recorder:
+        for obj in MyClass.pending.all():
+            obj.last_actor()
+    recorder.stats
+    # {'pending': {'queries': 1, 'seconds': 0.001},
+    #  'last_action': {'queries': 20, 'seconds': 0.004}}
+
+A query is counted for every operation running when it is executed, so the
+queries of ``state`` called by ``change_state`` are counted for both. Add
+:py:class:`QueryInstrumentationMiddleware` to the ``MIDDLEWARE`` setting to
+log the statistics of each request, and use :py:func:`assert_query_budget`
+in the tests.
+"""
+
+from contextlib import contextmanager
+import functools
+import logging
+import threading
+import time
+
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# number of entered recorders, the operations are not tracked without any
+_recorders = 0
+_recorders_lock = threading.Lock()
+
+
+def _operations():
+    try:
+        return _local.operations
+    except AttributeError:
+        _local.operations = []
+        return _local.operations
+
+
+class _Operation(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.pushed = False
+
+    def __enter__(self):
+        if _recorders:
+            _operations().append(self.name)
+            self.pushed = True
+
+    def __exit__(self, *exc_info):
+        if self.pushed:
+            _operations().pop()
+            self.pushed = False
+
+    def __call__(self, function):
+        name = self.name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _recorders:
+                return function(*args, **kwargs)
+            operations = _operations()
+            operations.append(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                operations.pop()
+        return wrapper
+
+
+def operation(name):
+    """ Attribute the queries executed in the block, or by the decorated
+    function, to an operation. Nothing is done while no
+    :py:class:`QueryRecorder` is entered.
+
+    :param name: the name of the operation
+    :type name: a string
+    """
+    return _Operation(name)
+
+
+class QueryRecorder(object):
+    """ Counts the queries executed by each operation, and their duration,
+    while it is entered. ::
+
+    .. py:attribute:: stats
+
+        The number of queries and the time spent in them, in seconds,
+        indexed by operation name
+    """
+
+    def __init__(self, using=None):
+        """
+        :param using: the aliases of the databases to watch, all if not given
+        :type using: a list of strings
+        """
+        self.using = using
+        self.stats = {}
+        self._wrappers = []
+
+    def __enter__(self):
+        global _recorders
+        with _recorders_lock:
+            _recorders += 1
+        aliases = self.using or [connection.alias
+            for connection in connections.all()]
+        for alias in aliases:
+            wrapper = connections[alias].execute_wrapper(self)
+            wrapper.__enter__()
+            self._wrappers.append(wrapper)
+        return self
+
+    def __exit__(self, *exc_info):
+        global _recorders
+        while self._wrappers:
+            self._wrappers.pop().__exit__(*exc_info)
+        with _recorders_lock:
+            _recorders -= 1
+
+    def __call__(self, execute, sql, params, many, context):
+        names = set(_operations())
+        if not names:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            for name in names:
+                stats = self.stats.setdefault(name,
+                    {'queries': 0, 'seconds': 0.0})
+                stats['queries'] += 1
+                stats['seconds'] += duration
+
+
+class QueryInstrumentationMiddleware(object):
+    """ Logs the queries of the workflow_activity operations of each request
+    on the ``workflow_activity.instrumentation`` logger, at the debug level.
+    The statistics are also available as ``request.workflow_queries``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryRecorder() as recorder:
+            request.workflow_queries = recorder.stats
+            response = self.get_response(request)
+        if recorder.stats:
+            logger.debug('%s %s: %s', request.method, request.path,
+                ', '.join('{0} {1[queries]} queries in {1[seconds]:.3f}s'
+                    .format(name, stats)
+                    for name, stats in sorted(recorder.stats.items())))
+        return response
+
+
+@contextmanager
+def assert_query_budget(budgets, using=None):
+    """ Fail when an operation executes more queries than its budget in the
+    block ::
+
+        with assert_query_budget({'last_action': 0, 'pending': 1}):
+            for obj in MyClass.pending.with_last_action():
+                obj.last_actor()
+
+    :param budgets: the maximal number of queries, indexed by operation name
+    :type budgets: a dict
+    :param using: the aliases of the databases to watch, all if not given
+    :type using: a list of strings
+    :raises AssertionError: if a budget is exceeded
+    """
+    with QueryRecorder(using) as recorder:
+        yield recorder
+    exceeded = ['{0} executed {1} queries (budget {2})'.format(
+            name, recorder.stats[name]['queries'], budget)
+        for name, budget in sorted(budgets.items())
+        if recorder.stats.get(name, {}).get('queries', 0) > budget]
+    if exceeded:
+        raise AssertionError('Query budget exceeded: ' + ', '.join(exceeded))
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+workflow_activity.management.commands.archive_workflow_activity
+===============================================================
+
+Moves the old actions out of the :py:class:`~workflow_activity.models.Action`
+table, into the :py:class:`~workflow_activity.models.ArchivedAction` table or
+into gzipped JSON Lines files. The retention policies can be combined, an
+action is archived when it matches all of them. ::
+
+    # actions older than a year, keeping the 10 latest actions per instance
+    ./manage.py archive_workflow_activity --older-than 365 --keep-last 10
+
+    # actions of a workflow, into a file of the /var/archives directory
+    ./manage.py archive_workflow_activity --workflow Standard \\
+        --to jsonl --directory /var/archives
+
+The actions are moved by batches, each batch in its own short transaction.
+The JSON Lines files are written before the actions are deleted: an
+interrupted run may leave a batch both in a file and in the table, it is
+written again by the next run.
+"""
+
+import datetime
+import gzip
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from workflow_activity.models import Action, ArchivedAction
+
+from .export_workflow_activity import serialize
+
+
+def newer_actions_count():
+    """ Count the actions processed on the same instance after an action
+
+    :rtype: an expression to annotate actions with
+    """
+    newer = Action.objects.filter(content_type=OuterRef('content_type'),
+            object_id=OuterRef('object_id')).filter(
+        Q(process_date__gt=OuterRef('process_date'))
+        | Q(process_date=OuterRef('process_date'), pk__gt=OuterRef('pk'))
+    ).order_by().values('content_type').annotate(count=Count('pk'))
+    return Coalesce(Subquery(newer.values('count'), output_field=IntegerField()), 0)
+
+
+def archive_row(action):
+    """ The archived row of an action, with the identifiers needed to
+    restore it
+
+    :param action: an action fetched with its relations
+    :type action: :py:class:`~workflow_activity.models.Action`
+    :rtype: a dict
+    """
+    row = serialize(action)
+    row.update({
+        'creation_date': action.creation_date.isoformat(),
+        'content_type_id': action.content_type_id,
+        'workflow_id': action.workflow_id,
+        'transition_id': action.transition_id,
+        'previous_state_id': action.previous_state_id,
+    })
+    return row
+
+
+class Command(BaseCommand):
+    help = 'Move the old workflow actions to the archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, metavar='DAYS',
+            help='Archive the actions processed more than DAYS days ago')
+        parser.add_argument('--workflow', action='append', default=[],
+            help='Archive the actions of this workflow (name or id), can be '
+            'repeated')
+        parser.add_argument('--keep-last', type=int, metavar='N',
+            help='Keep the N latest actions of each instance')
+        parser.add_argument('--to', choices=('table', 'jsonl'),
+            default='table', help='Archive destination (default: table)')
+        parser.add_argument('--directory', default='.',
+            help='Directory of the JSON Lines archives (default: current '
+            'directory)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Number of actions moved in each transaction')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Only count the actions to archive')
+
+    def get_queryset(self, options):
+        if options['older_than'] is None and not options['workflow'] \
+                and options['keep_last'] is None:
+            raise CommandError('A retention policy is required: '
+                '--older-than, --workflow or --keep-last')
+        actions = Action.objects.all()
+        if options['older_than'] is not None:
+            actions = actions.filter(process_date__lt=timezone.now()
+                - datetime.timedelta(days=options['older_than']))
+        if options['workflow']:
+            ids = [int(value) for value in options['workflow']
+                if value.isdigit()]
+            names = [value for value in options['workflow']
+                if not value.isdigit()]
+            actions = actions.filter(Q(workflow__in=ids)
+                | Q(workflow__name__in=names))
+        if options['keep_last'] is not None:
+            actions = actions.annotate(newer_count=newer_actions_count()) \
+                .filter(newer_count__gte=options['keep_last'])
+        return actions
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        actions = self.get_queryset(options)
+        if options['dry_run']:
+            self.stdout.write('{0} actions to archive'.format(actions.count()))
+            return
+
+        path = os.path.join(options['directory'], 'actions-{0}.jsonl.gz'
+            .format(timezone.now().strftime('%Y%m%d%H%M%S')))
+        archive = None
+
+        archived, last_pk = 0, 0
+        try:
+            while True:
+                # the actions of a batch are fetched again by primary key so
+                # that the transaction only holds locks on the batch
+                pks = list(actions.filter(pk__gt=last_pk).order_by('pk')
+                    .values_list('pk', flat=True)[:options['batch_size']])
+                if not pks:
+                    break
+                last_pk = pks[-1]
+                with transaction.atomic():
+                    batch = Action.objects.filter(pk__in=pks).select_related(
+                        'actor', 'workflow', 'transition', 'previous_state',
+                        'content_type').select_for_update(of=('self', ))
+                    if options['to'] == 'table':
+                        ArchivedAction.objects.bulk_create(
+                            [ArchivedAction.from_action(action)
+                                for action in batch],
+                            ignore_conflicts=True)
+                    else:
+                        if archive is None:
+                            archive = gzip.open(path, 'at')
+                        for action in batch:
+                            archive.write(json.dumps(archive_row(action))
+                                + '\n')
+                        archive.flush()
+                    archived += Action.objects.filter(pk__in=pks).delete()[0]
+        finally:
+            if archive is not None:
+                archive.close()
+        self.stdout.write('{0} actions archived'.format(archived))
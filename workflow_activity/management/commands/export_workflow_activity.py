@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+workflow_activity.management.commands.export_workflow_activity
+==============================================================
+
+Streams the history of the workflow managed instances to CSV or JSON Lines
+without loading it in memory. ::
+
+    ./manage.py export_workflow_activity --format jsonl \\
+        --workflow Standard --since 2015-01-01 --output actions.jsonl
+"""
+
+import csv
+import datetime
+import json
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from workflow_activity.models import Action
+
+
+FIELDS = ('id', 'process_date', 'content_type', 'object_id', 'workflow',
+    'transition', 'previous_state', 'actor_id', 'actor')
+
+
+def parse_moment(value):
+    """ Parse a date or a datetime given on the command line
+
+    :param value: ISO 8601 date or datetime
+    :type value: a string
+    :rtype: an aware :py:class:`datetime.datetime` when ``USE_TZ`` is on
+    """
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            date = parse_date(value)
+            if date is None:
+                raise ValueError(value)
+            moment = datetime.datetime.combine(date, datetime.time())
+    except ValueError:
+        raise CommandError('Invalid date: {0}'.format(value))
+    if settings.USE_TZ and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def serialize(action):
+    """ The exported row of an action
+
+    :param action: an action fetched with its relations
+    :type action: :py:class:`~workflow_activity.models.Action`
+    :rtype: a dict
+    """
+    return {
+        'id': action.pk,
+        'process_date': action.process_date.isoformat(),
+        'content_type': '{0.app_label}.{0.model}'.format(action.content_type),
+        'object_id': action.object_id,
+        'workflow': action.workflow.name,
+        'transition': action.transition.name,
+        'previous_state': action.previous_state.name,
+        'actor_id': action.actor_id,
+        'actor': action.actor_name,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Export the workflow actions to CSV or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+            default='csv', help='Output format (default: csv)')
+        parser.add_argument('--workflow', action='append', default=[],
+            help='Name or id of a workflow, can be repeated')
+        parser.add_argument('--content-type', action='append', default=[],
+            help='app_label.model of the managed instances, can be repeated')
+        parser.add_argument('--since',
+            help='Export the actions processed from this date (included)')
+        parser.add_argument('--until',
+            help='Export the actions processed before this date (excluded)')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+            help='Number of rows fetched at once from the database')
+        parser.add_argument('--output',
+            help='Destination file (default: standard output)')
+
+    def get_queryset(self, options):
+        actions = Action.objects.select_related('actor', 'workflow',
+            'transition', 'previous_state', 'content_type')
+        if options['workflow']:
+            ids = [int(value) for value in options['workflow']
+                if value.isdigit()]
+            names = [value for value in options['workflow']
+                if not value.isdigit()]
+            actions = actions.filter(Q(workflow__in=ids)
+                | Q(workflow__name__in=names))
+        if options['content_type']:
+            ctypes = []
+            for value in options['content_type']:
+                try:
+                    app_label, model = value.lower().split('.')
+                    ctypes.append(ContentType.objects.get_by_natural_key(
+                        app_label, model))
+                except (ValueError, ContentType.DoesNotExist):
+                    raise CommandError(
+                        'Unknown content type: {0}'.format(value))
+            actions = actions.filter(content_type__in=ctypes)
+        if options['since']:
+            actions = actions.filter(
+                process_date__gte=parse_moment(options['since']))
+        if options['until']:
+            actions = actions.filter(
+                process_date__lt=parse_moment(options['until']))
+        return actions.order_by('pk')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        rows = (serialize(action) for action in self.get_queryset(options)
+            .iterator(chunk_size=options['chunk_size']))
+        output = self.stdout
+        if options['output']:
+            output = open(options['output'], 'w', newline='',
+                encoding='utf-8')
+        try:
+            if options['format'] == 'csv':
+                writer = csv.DictWriter(output, FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    output.write(json.dumps(row) + '\n')
+        finally:
+            if options['output']:
+                output.close()
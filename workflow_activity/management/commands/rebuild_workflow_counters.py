@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+"""
+workflow_activity.management.commands.rebuild_workflow_counters
+===============================================================
+
+Counts again the workflow managed instances in each state and replaces the
+:py:class:`~workflow_activity.models.StateCounter` table. Run it after the
+states were set without ``change_state`` (``workflows.utils.set_state``,
+fixtures, raw SQL...). ::
+
+    ./manage.py rebuild_workflow_counters
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from workflow_activity.models import StateCounter
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the counters of the instances in each state'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+            help='Database to rebuild (default: default)')
+
+    def handle(self, *args, **options):
+        count = StateCounter.rebuild(using=options['database'])
+        self.stdout.write('{0} state counters fixed'.format(count))
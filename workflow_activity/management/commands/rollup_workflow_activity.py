@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+"""
+workflow_activity.management.commands.rollup_workflow_activity
+==============================================================
+
+Adds the stays ended by the new actions to the
+:py:class:`~workflow_activity.models.StateDuration` rollup. Run it
+periodically, only the actions created since the last run, and during the
+safety margin before it, are read. ::
+
+    ./manage.py rollup_workflow_activity
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from workflow_activity.models import StateDuration
+
+
+class Command(BaseCommand):
+    help = 'Roll up the durations of the states of the new actions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+            help='Database to roll up (default: default)')
+
+    def handle(self, *args, **options):
+        count = StateDuration.update(using=options['database'])
+        self.stdout.write('{0} state durations added'.format(count))
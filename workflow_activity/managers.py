@@ -9,12 +9,115 @@ plugged into the WorkflowManagedInstance model and are also available in each
 model that inherits the WorkflowManagedInstance model.
 """
 
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
 from django.db import models
+from django.db.models import F
+from django.db.models import Window
+from django.db.models.functions import Coalesce
+from django.db.models.functions import Lag
+from permissions.models import PrincipalRoleRelation
+from workflows.models import State
+from workflows.models import StateObjectRelation
+
+from .instrumentation import operation
+from .utils import PERCENTILES
+from .utils import duration_statistics
+from .utils import get_ending_state_ids
+from .utils import get_pending_state_ids
+from .utils import seconds_between
+from .utils import workflow_graphs_compiled
+
+
+def _use_compiled_states():
+    """ The compiled graphs cannot be built from an event loop, where the
+    ORM may not be called synchronously """
+    if workflow_graphs_compiled():
+        return True
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return True
+    return False
+
+
+def state_at_expression(model, object_id, timestamp):
+    """ Expression of the primary key of the state of workflow managed
+    instances at a given moment, reconstructed from their actions and from
+    their archived actions
+
+    :param model: the workflow managed model
+    :param object_id: the primary key of the instance, or a reference to it
+        such as ``OuterRef('pk')``
+    :param timestamp: the moment
+    :type timestamp: a datetime
+
+    The archived actions of an instance are older than its remaining
+    actions, they are only read when the remaining actions do not tell the
+    state.
+    """
+    ctype = ContentType.objects.get_for_model(model)
+    before = []
+    after = []
+    for action_model in (model._meta.get_field('actions').related_model,
+            apps.get_model('workflow_activity', 'ArchivedAction')):
+        actions = action_model.objects.filter(content_type=ctype,
+            object_id=object_id)
+        before.append(models.Subquery(actions.filter(
+            process_date__lte=timestamp).order_by('-process_date', '-pk')
+            .values('transition__destination')[:1]))
+        after.insert(0, models.Subquery(actions.filter(
+            process_date__gt=timestamp).order_by('process_date', 'pk')
+            .values('previous_state')[:1]))
+    current = StateObjectRelation.objects.filter(content_type=ctype,
+        content_id=object_id).values('state')[:1]
+    # the destination of the latest action before the moment, or the state
+    # left by the first action after it, or the current state if the
+    # instance never changed state
+    return Coalesce(*(before + after + [models.Subquery(current)]),
+        output_field=models.IntegerField())
 
 
 class BaseQuerySet(models.QuerySet):
     """ Base queryset for all workflow managed instances managers."""
 
+    # the instrumentation attributes the queries of the queryset to this
+    # operation
+    _operation = 'queryset'
+
+    def _clone(self):
+        clone = super(BaseQuerySet, self)._clone()
+        clone._operation = self._operation
+        return clone
+
+    def _fetch_all(self):
+        with operation(self._operation):
+            super(BaseQuerySet, self)._fetch_all()
+
+    def count(self):
+        with operation(self._operation):
+            return super(BaseQuerySet, self).count()
+
+    def exists(self):
+        with operation(self._operation):
+            return super(BaseQuerySet, self).exists()
+
+    if not hasattr(models.QuerySet, '__aiter__'):
+        def __aiter__(self):
+            """ Iterate over the workflow managed instances with ``async
+            for``, the results are fetched in a thread (Django < 4.1)
+            """
+            async def generator():
+                await sync_to_async(self._fetch_all)()
+                for obj in self._result_cache:
+                    yield obj
+            return generator()
+
     def by_state(self, state_name):
         """ Search workflow managed instances by state
 
@@ -23,10 +126,130 @@ class BaseQuerySet(models.QuerySet):
         """
         return self.filter(state_relation__state__name=state_name)
 
+    def with_state(self):
+        """ Resolve the state of all the workflow managed instances of the
+        queryset with a single query, so that accessing the ``state`` property
+        of the instances does not hit the database anymore
+        """
+        return self.prefetch_related(models.Prefetch('state_relation',
+            queryset=StateObjectRelation.objects.select_related(
+                'state__workflow')))
+
+    def with_last_action(self):
+        """ Annotate all the workflow managed instances of the queryset with
+        their latest action, so that ``last_action``, ``last_actor``,
+        ``last_transition`` and ``last_state`` do not hit the database anymore.
+        The following annotations are available on each instance : ::
+
+        * ``last_action_id``: the identifier of the latest action
+        * ``last_actor_id``: the identifier of the latest actor
+        * ``last_transition_id``: the identifier of the latest transition
+        * ``last_state_id``: the identifier of the previous state
+
+        The latest actions themselves are fetched with one additional query.
+        """
+        action_model = self.model._meta.get_field('actions').related_model
+        latest = action_model.objects.filter(
+            content_type=ContentType.objects.get_for_model(self.model),
+            object_id=models.OuterRef('pk')
+        ).order_by('-process_date', '-pk')
+        last_actions = action_model.objects.filter(pk=models.Subquery(
+            action_model.objects.filter(
+                content_type=models.OuterRef('content_type'),
+                object_id=models.OuterRef('object_id')
+            ).order_by('-process_date', '-pk').values('pk')[:1]
+        )).select_related('actor', 'transition', 'previous_state', 'workflow')
+
+        return self.annotate(
+            last_action_id=models.Subquery(latest.values('pk')[:1]),
+            last_actor_id=models.Subquery(latest.values('actor')[:1]),
+            last_transition_id=models.Subquery(
+                latest.values('transition')[:1]),
+            last_state_id=models.Subquery(
+                latest.values('previous_state')[:1]),
+        ).prefetch_related(models.Prefetch('actions', queryset=last_actions,
+            to_attr='_last_actions'))
+
+    def with_state_at(self, timestamp):
+        """ Annotate all the workflow managed instances of the queryset with
+        the primary key of their state at a given moment, ``state_at_id``. It
+        is ``None`` for the instances created after this moment
+
+        :param timestamp: the moment
+        :type timestamp: a datetime
+
+        The state of each instance is found from its latest action before
+        the moment, in the same query.
+        """
+        return self.annotate(state_at_id=models.Case(
+            models.When(creation_date__lte=timestamp,
+                then=state_at_expression(self.model, models.OuterRef('pk'),
+                    timestamp)),
+            default=None, output_field=models.IntegerField()))
+
+    def change_state(self, transition, actor):
+        """ Set new state for all the workflow managed instances of the
+        queryset at once. See
+        :py:meth:`~workflow_activity.models.WorkflowManagedInstance.bulk_change_state`
+
+        :param transition: a transition object
+        :type transition: `workflows.models.Transition <http://packages.python.org/django-workflows/api.html#workflows.models.Transition>`_
+        :param actor: a user object
+        :type actor: `django.contrib.auth.User <https://docs.djangoproject.com/en/1.4/topics/auth/#users>`_
+        :return: the number of instances that changed state
+        :rtype: an integer
+        """
+        return self.model.bulk_change_state(self, transition, actor)
+
+    def set_workflow(self, workflow=None):
+        """ Initiate a workflow for the workflow managed instances of the
+        queryset that are not in a workflow state. See
+        :py:meth:`~workflow_activity.models.WorkflowManagedInstance.bulk_set_workflow`
+
+        :param workflow: the workflow, the workflow of the model if not given
+        :type workflow: `workflows.models.Workflow <http://packages.python.org/django-workflows/api.html#workflows.models.Workflow>`_
+        :return: the number of instances that got the workflow
+        :rtype: an integer
+        """
+        return self.model.bulk_set_workflow(self, workflow)
+
+    def remove_workflow(self):
+        """ Remove entirely the workflow of the workflow managed instances of
+        the queryset. See
+        :py:meth:`~workflow_activity.models.WorkflowManagedInstance.bulk_remove_workflow`
+
+        :return: the number of instances that were in a workflow state
+        :rtype: an integer
+        """
+        return self.model.bulk_remove_workflow(self)
+
+    def allowed_transitions(self, user):
+        """ Allowed transitions user can do on all the workflow managed
+        instances of the queryset. See
+        :py:meth:`~workflow_activity.models.WorkflowManagedInstance.allowed_transitions_bulk`
+
+        :param user: a user object
+        :type user: `django.contrib.auth.User <https://docs.djangoproject.com/en/1.4/topics/auth/#users>`_
+        :return: allowed transitions indexed by primary key of instance
+        :rtype: a dict of lists of `workflows.models.Transition <http://packages.python.org/django-workflows/api.html#workflows.models.Transition>`_
+        """
+        return self.model.allowed_transitions_bulk(self, user)
+
 
 class PendingQuerySet(BaseQuerySet):
     """ Base queryset for pending workflow managed instances managers."""
 
+    def _with_state_permission(self, roles, permission):
+        """ Only the instances whose state gives the permission to one of the
+        roles, as a single EXISTS subquery
+        """
+        return self.filter(models.Exists(StateObjectRelation.objects.filter(
+            content_type=ContentType.objects.get_for_model(self.model),
+            content_id=models.OuterRef('pk'),
+            state__statepermissionrelation__role__in=roles,
+            state__statepermissionrelation__permission__codename=permission
+        )))
+
     def editable_by_roles(self, roles, edit='edit'):
         """ Only the instances that are editable by some roles (based on
         permissions for this role)
@@ -37,10 +260,59 @@ class PendingQuerySet(BaseQuerySet):
         :param edit: the codename of the permission to match
         :type edit: a string
         """
-        return self.filter(
-            state_relation__state__statepermissionrelation__role__in=roles,
-            state_relation__state__statepermissionrelation__permission__codename=edit
-        )
+        return self._with_state_permission(roles, edit)
+
+    def editable_by_user(self, user, permission='edit'):
+        """ Only the instances that are editable by a user (based on
+        permissions for the global, group and local roles of the user). The
+        roles are resolved by the database
+
+        :param user: a user object
+        :type user: `django.contrib.auth.User <https://docs.djangoproject.com/en/1.4/topics/auth/#users>`_
+        :param permission: the codename of the permission to match
+        :type permission: a string
+        """
+        if user.is_superuser:
+            return self.all()
+        if user.is_anonymous:
+            return self.none()
+
+        roles = PrincipalRoleRelation.objects.filter(
+            models.Q(user=user) | models.Q(group__in=user.groups.all()),
+            models.Q(content_id=None) | models.Q(
+                content_type=ContentType.objects.get_for_model(self.model),
+                content_id=models.OuterRef(models.OuterRef('pk')))
+        ).values('role')
+        return self._with_state_permission(roles, permission)
+
+
+class StateIds(models.Expression):
+    """ The primary keys of the pending or ending states, resolved when the
+    query is compiled. They are taken from the compiled workflow graphs, or
+    from a subquery in an event loop until the graphs are compiled, so that
+    building a queryset runs no query
+    """
+
+    def __init__(self, ending):
+        """
+        :param ending: the ending states, or the states with transitions
+        :type ending: a boolean
+        """
+        super(StateIds, self).__init__(output_field=models.IntegerField())
+        self.ending = ending
+
+    def as_sql(self, compiler, connection):
+        if not _use_compiled_states():
+            states = State.objects.filter(
+                transitions__isnull=self.ending).values('pk')
+            sql, params = states.query.get_compiler(
+                connection=connection).as_sql()
+            return '({0})'.format(sql), params
+        state_ids = sorted(get_ending_state_ids() if self.ending
+            else get_pending_state_ids())
+        if not state_ids:
+            raise EmptyResultSet
+        return '({0})'.format(', '.join(['%s'] * len(state_ids))), state_ids
 
 
 class PendingManager(models.Manager):
@@ -49,11 +321,12 @@ class PendingManager(models.Manager):
     """
 
     def get_queryset(self):
-        """ Only the instances that are in non ending states
+        """ Only the instances that are in non ending states, see
+        :py:class:`StateIds`
         """
-        return super(PendingManager, self).get_queryset()\
-            .filter(state_relation__state__isnull=False)\
-            .exclude(state_relation__state__transitions__isnull=True)
+        queryset = super(PendingManager, self).get_queryset()
+        queryset._operation = 'pending'
+        return queryset.filter(state_relation__state__in=StateIds(False))
 
 
 class EndedManager(models.Manager):
@@ -62,8 +335,98 @@ class EndedManager(models.Manager):
     """
 
     def get_queryset(self):
-        """ Only the instances that are in ending states
+        """ Only the instances that are in ending states, see
+        :py:class:`StateIds`
+        """
+        queryset = super(EndedManager, self).get_queryset()
+        queryset._operation = 'ended'
+        return queryset.filter(state_relation__state__in=StateIds(True))
+
+
+class ActionQuerySet(models.QuerySet):
+    """ Queryset of the actions """
+
+    def with_entered_date(self):
+        """ Annotate each action with the date of the previous action on the
+        same instance, ``entered_date``: the date the instance entered the
+        ``previous_state`` of the action. It is ``None`` for the first action
+        of an instance
         """
-        return super(EndedManager, self).get_queryset()\
-            .filter(state_relation__state__isnull=False)\
-            .filter(state_relation__state__transitions__isnull=True)
+        return self.annotate(entered_date=Window(Lag('process_date'),
+            partition_by=[F('content_type'), F('object_id')],
+            order_by=[F('process_date').asc(), F('pk').asc()]))
+
+    def durations_sql(self):
+        """ SQL of the stays of the instances in the previous state of the
+        actions, for all the actions following another one. The selected
+        columns are ``action_id``, ``workflow_id``, ``state_id``,
+        ``content_type_id``, ``object_id``, ``entered_date``, ``left_date``
+        and ``seconds``
+
+        :return: the SQL and its parameters
+        :rtype: a tuple
+        """
+        actions = self.with_entered_date().values('pk', 'workflow',
+            'previous_state', 'content_type', 'object_id', 'process_date',
+            'entered_date')
+        sql, params = actions.query.sql_with_params()
+        return ('SELECT d.id AS action_id, d.workflow_id, '
+            'd.previous_state_id AS state_id, d.content_type_id, d.object_id, '
+            'd.entered_date, d.process_date AS left_date, {0} AS seconds '
+            'FROM ({1}) d WHERE d.entered_date IS NOT NULL'.format(
+                seconds_between(connections[self.db], 'd.process_date',
+                    'd.entered_date'), sql), params)
+
+    def time_in_state(self, since=None, until=None, percentiles=PERCENTILES):
+        """ How long the instances stayed in each state, computed from the
+        consecutive actions in the database
+
+        :param since: only the stays ended from this date
+        :type since: a datetime
+        :param until: only the stays ended before this date
+        :type until: a datetime
+        :param percentiles: the percentiles to compute, between 1 and 100
+        :type percentiles: a list of integers
+        :return: the ``count``, ``average`` and ``percentiles`` of the stays,
+            in seconds, indexed by state
+        :rtype: a dict
+
+        The queryset filters apply before the actions are paired, so filter
+        on workflows or content types but pass the dates as arguments.
+        """
+        sql, params = self.durations_sql()
+        ops = connections[self.db].ops
+        conditions = []
+        if since is not None:
+            conditions.append('s.left_date >= %s')
+            params += (ops.adapt_datetimefield_value(since), )
+        if until is not None:
+            conditions.append('s.left_date < %s')
+            params += (ops.adapt_datetimefield_value(until), )
+        if conditions:
+            sql = 'SELECT s.* FROM ({0}) s WHERE {1}'.format(sql,
+                ' AND '.join(conditions))
+        return _by_state(duration_statistics(sql, params, percentiles,
+            self.db))
+
+
+class StateDurationQuerySet(models.QuerySet):
+    """ Queryset of the stays rolled up by
+    :py:meth:`~workflow_activity.models.StateDuration.update` """
+
+    def time_in_state(self, percentiles=PERCENTILES):
+        """ Same as :py:meth:`ActionQuerySet.time_in_state`, from the rolled
+        up stays
+
+        :param percentiles: the percentiles to compute, between 1 and 100
+        :type percentiles: a list of integers
+        :rtype: a dict
+        """
+        sql, params = self.values('state', 'seconds').query.sql_with_params()
+        return _by_state(duration_statistics(sql, params, percentiles,
+            self.db))
+
+
+def _by_state(statistics):
+    states = State.objects.in_bulk(list(statistics))
+    return dict((states[pk], value) for pk, value in statistics.items())
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+workflow_activity.metrics
+=========================
+
+Counters and latency histograms of the state changes, sent to the backend
+named by the ``WORKFLOW_ACTIVITY_METRICS`` setting. By default they are kept
+in :py:data:`registry`, in the memory of the process, and can be exposed in
+the Prometheus text format with :py:func:`metrics_view`. ::
+
+    urlpatterns = [
+        path('metrics', workflow_activity.metrics.metrics_view),
+    ]
+
+The following metrics are recorded :
+
+* ``workflow_activity_transitions_total``: the instances that changed state,
+  labelled by ``workflow`` (primary key), ``transition`` and
+  ``content_type``
+* ``workflow_activity_change_state_seconds``: the duration of
+  ``change_state``, with the same labels
+* ``workflow_activity_bulk_change_state_seconds``: the duration of
+  ``bulk_change_state``, with the same labels
+* ``workflow_activity_state_conflicts_total``: the optimistic
+  ``change_state`` that found the state changed by another transaction,
+  with the same labels
+* ``workflow_activity_receivers_seconds``: the time spent in the receivers
+  of a ``signal``
+* ``workflow_activity_receiver_errors_total``: the exceptions raised by a
+  ``receiver`` of a ``signal``
+"""
+
+import bisect
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+
+# type and description of the metrics, for the Prometheus text format
+METRICS = {
+    'workflow_activity_transitions_total': ('counter',
+        'Instances that changed state'),
+    'workflow_activity_change_state_seconds': ('histogram',
+        'Duration of change_state'),
+    'workflow_activity_bulk_change_state_seconds': ('histogram',
+        'Duration of bulk_change_state'),
+    'workflow_activity_state_conflicts_total': ('counter',
+        'Optimistic state changes in conflict with another transaction'),
+    'workflow_activity_receivers_seconds': ('histogram',
+        'Time spent in the receivers of a signal'),
+    'workflow_activity_receiver_errors_total': ('counter',
+        'Exceptions raised by the receivers of a signal'),
+}
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0,
+    10.0)
+
+
+class MetricsBackend(object):
+    """ Interface of the metrics backends, it records nothing. A backend
+    sending the metrics elsewhere (StatsD, OpenTelemetry...) implements
+    these two methods and is named by the ``WORKFLOW_ACTIVITY_METRICS``
+    setting.
+    """
+
+    def increment(self, name, value=1, **labels):
+        """ Increment a counter
+
+        :param name: the name of the metric
+        :type name: a string
+        :param value: the increment
+        :type value: a number
+        :param labels: the labels of the metric
+        """
+
+    def observe(self, name, value, **labels):
+        """ Record a value, such as a duration in seconds, in a histogram
+
+        :param name: the name of the metric
+        :type name: a string
+        :param value: the observed value
+        :type value: a number
+        :param labels: the labels of the metric
+        """
+
+
+class Registry(MetricsBackend):
+    """ Keeps the metrics in the memory of the process """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            try:
+                counts, total = self._histograms[key]
+            except KeyError:
+                counts, total = [0] * (len(self.buckets) + 1), 0
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._histograms[key] = (counts, total + value)
+
+    def value(self, name, **labels):
+        """ The value of a counter, or the number of values of a histogram
+
+        :rtype: a number
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return sum(self._histograms[key][0])
+            return self._counters.get(key, 0)
+
+    def clear(self):
+        """ Forget all the metrics """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """ The metrics in the Prometheus text format
+
+        :rtype: a string
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(counts), total))
+                for key, (counts, total) in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name, default_type):
+            if name not in described:
+                described.add(name)
+                metric_type, description = METRICS.get(name,
+                    (default_type, name))
+                lines.append('# HELP {0} {1}'.format(name, description))
+                lines.append('# TYPE {0} {1}'.format(name, metric_type))
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append('{0}{1} {2}'.format(name, _labels(labels), value))
+        for (name, labels), (counts, total) in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(name, _labels(
+                    labels + (('le', _number(bound)), )), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(name, _labels(labels),
+                _number(total)))
+            lines.append('{0}_count{1} {2}'.format(name, _labels(labels),
+                cumulative))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value)
+        .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+#: the default backend
+registry = Registry()
+
+_backends = {}
+
+
+def get_backend():
+    """ The backend named by the ``WORKFLOW_ACTIVITY_METRICS`` setting (the
+    dotted path of an instance or a class), the in-process
+    :py:data:`registry` if not set. ``None`` disables the metrics
+
+    :rtype: a :py:class:`MetricsBackend`
+    """
+    path = getattr(settings, 'WORKFLOW_ACTIVITY_METRICS',
+        'workflow_activity.metrics.registry')
+    try:
+        return _backends[path]
+    except KeyError:
+        backend = import_string(path) if path else MetricsBackend
+        if isinstance(backend, type):
+            backend = backend()
+        _backends[path] = backend
+        return backend
+
+
+def metrics_view(request):
+    """ Expose the metrics of the default registry to Prometheus """
+    return HttpResponse(registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow_activity', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['content_type', 'object_id', '-process_date'], name='wfa_action_object_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['actor', '-process_date'], name='wfa_action_actor_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['workflow', 'transition'], name='wfa_action_transition_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('workflows', '0001_initial'),
+        ('workflow_activity', '0002_action_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedAction',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('process_date', models.DateTimeField(verbose_name='Creation date')),
+                ('creation_date', models.DateTimeField(verbose_name='Date of creation')),
+                ('archive_date', models.DateTimeField(auto_now_add=True, verbose_name='Date of archive')),
+                ('object_id', models.PositiveIntegerField()),
+                ('actor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Actor')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.contenttype')),
+                ('previous_state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflows.state', verbose_name='Previous state')),
+                ('transition', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflows.transition', verbose_name='Transition')),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflows.workflow', verbose_name='Workflow')),
+            ],
+            options={
+                'verbose_name': 'Archived action',
+                'verbose_name_plural': 'Archived actions',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedaction',
+            index=models.Index(fields=['content_type', 'object_id', '-process_date'], name='wfa_archived_object_date_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0001_initial'),
+        ('contenttypes', '0001_initial'),
+        ('workflow_activity', '0004_action_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateDuration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action_id', models.IntegerField(unique=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('entered_date', models.DateTimeField(verbose_name='Date of entry')),
+                ('left_date', models.DateTimeField(verbose_name='Date of exit')),
+                ('seconds', models.FloatField(verbose_name='Duration')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.contenttype')),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflows.state', verbose_name='State')),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflows.workflow', verbose_name='Workflow')),
+            ],
+            options={
+                'verbose_name': 'State duration',
+                'verbose_name_plural': 'State durations',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='stateduration',
+            index=models.Index(fields=['workflow', 'state', 'seconds'], name='wfa_duration_state_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+from django.db.models import Q
+import django.db.models.deletion
+
+
+def count_states(apps, schema_editor):
+    """ Count the instances already in each state, so that the counters of
+    an existing database start right """
+    # the workflow managed models are known from the code only
+    from django.apps import apps as global_apps
+    from workflow_activity.models import WorkflowManagedInstance
+
+    using = schema_editor.connection.alias
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    StateObjectRelation = apps.get_model('workflows', 'StateObjectRelation')
+    StateCounter = apps.get_model('workflow_activity', 'StateCounter')
+    models_q = Q(pk__in=[])
+    for model in global_apps.get_models():
+        if issubclass(model, WorkflowManagedInstance):
+            models_q |= Q(app_label=model._meta.app_label,
+                model=model._meta.model_name)
+    ctypes = ContentType.objects.using(using).filter(models_q)
+    StateCounter.objects.using(using).bulk_create([StateCounter(
+            content_type_id=row['content_type'],
+            workflow_id=row['state__workflow'], state_id=row['state'],
+            count=row['count'])
+        for row in StateObjectRelation.objects.using(using).filter(
+            content_type__in=ctypes).values('content_type',
+            'state__workflow', 'state').annotate(count=Count('pk'))
+            .order_by()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('workflows', '0001_initial'),
+        ('workflow_activity', '0005_stateduration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0, verbose_name='Count')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.contenttype')),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflows.state', verbose_name='State')),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflows.workflow', verbose_name='Workflow')),
+            ],
+            options={
+                'verbose_name': 'State counter',
+                'verbose_name_plural': 'State counters',
+                'unique_together': {('content_type', 'workflow', 'state')},
+            },
+        ),
+        migrations.RunPython(count_states, migrations.RunPython.noop),
+    ]
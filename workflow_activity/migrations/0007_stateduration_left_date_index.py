@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow_activity', '0006_statecounter'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stateduration',
+            index=models.Index(fields=['-left_date'], name='wfa_duration_left_date_idx'),
+        ),
+    ]
@@ -12,33 +12,63 @@ data on each action made by a user through an application interface
 
 """
 
-
+from collections import Counter
+import datetime
+import functools
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.fields import GenericRelation
 
-from django.db import models, transaction
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections, models, transaction
+from django.db import IntegrityError
 from django.dispatch import receiver
 from django.dispatch import Signal
 from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import gettext_lazy as _
 
+import permissions.models
 from permissions.utils import has_permission
 import workflows.models
-from workflows.utils import get_allowed_transitions
-from workflows.utils import get_state
-from workflows.utils import set_state
-from workflows.utils import set_workflow_for_object
 from workflows.utils import get_workflow_for_model
 
+from . import _WORKFLOW_GRAPHS
 from . import managers
-from .utils import get_ending_states
+from .exceptions import StateConflict
+from .instrumentation import operation
+from .metrics import get_backend as get_metrics
+from .utils import get_granted_permissions
+from .utils import get_granted_permissions_for_objects
+from .utils import copy_transition
+from .utils import get_workflow_graph
+from .utils import invalidate_workflow_graph
+from .utils import invalidate_workflow_ids
+from .utils import revalidate_workflow_graphs
+from .utils import update_permissions_for_objects
+
+
+logger = logging.getLogger(__name__)
 
+# number of instances whose relations are inserted by the same queries, to
+# stay below the limits of the databases on the parameters of a query
+BULK_BATCH_SIZE = 10000
 
-# signals to send when the state of a workflow managed instance is changed
-changed_state = Signal(providing_args=['transition', 'actor',
-    'previous_state'])
+
+# signals to send when the state of a workflow managed instance is changed,
+# with the transition, actor and previous_state arguments
+changed_state = Signal()
+# signals to send when the state of many workflow managed instances of the
+# same model is changed at once, with the instances, transition, actor and
+# previous_states (indexed by instance primary key) arguments
+bulk_changed_state = Signal()
 
 
 class Action(models.Model):
@@ -103,11 +133,26 @@ class Action(models.Model):
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey('content_type', 'object_id')
 
+    objects = managers.ActionQuerySet.as_manager()
+
 
     class Meta:
         verbose_name = _('Action')
         verbose_name_plural = _('Actions')
         app_label = 'workflow_activity'
+        indexes = [
+            # history of an instance (instance.actions, last_action)
+            models.Index(fields=['content_type', 'object_id', '-process_date'],
+                name='wfa_action_object_date_idx'),
+            # history of an actor
+            models.Index(fields=['actor', '-process_date'],
+                name='wfa_action_actor_date_idx'),
+            models.Index(fields=['workflow', 'transition'],
+                name='wfa_action_transition_idx'),
+            # date hierarchy of the admin
+            models.Index(fields=['-process_date'],
+                name='wfa_action_date_idx'),
+        ]
 
     def actor_name(self):
         return u'{0.first_name} {0.last_name}'.format(self.actor) \
@@ -124,6 +169,329 @@ class Action(models.Model):
             '{0.actor_name} - {0.transition.name}'.format(self) 
 
 
+class ArchivedAction(models.Model):
+    """ An action moved out of the :py:class:`Action` table by the
+    ``archive_workflow_activity`` command. It keeps the identifier and the
+    data of the original action. ::
+
+    .. py:attribute:: archive_date
+
+        The date the action was archived
+    """
+
+    id = models.IntegerField(primary_key=True)
+    actor = models.ForeignKey('auth.User', verbose_name=_('Actor'),
+            related_name='+', null=True, on_delete=models.CASCADE)
+    process_date = models.DateTimeField(verbose_name=_('Creation date'))
+    transition = models.ForeignKey('workflows.Transition',
+            verbose_name=_('Transition'), related_name='+', on_delete=models.CASCADE)
+    previous_state = models.ForeignKey('workflows.State',
+            verbose_name=_('Previous state'), related_name='+', on_delete=models.CASCADE)
+    workflow = models.ForeignKey('workflows.Workflow',
+            verbose_name=_('Workflow'), related_name='+', on_delete=models.CASCADE)
+    creation_date = models.DateTimeField(verbose_name=_('Date of creation'))
+    archive_date = models.DateTimeField(verbose_name=_('Date of archive'),
+            auto_now_add=True)
+
+    content_type = models.ForeignKey(ContentType, related_name='+',
+            on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+
+
+    class Meta:
+        verbose_name = _('Archived action')
+        verbose_name_plural = _('Archived actions')
+        app_label = 'workflow_activity'
+        indexes = [
+            models.Index(fields=['content_type', 'object_id', '-process_date'],
+                name='wfa_archived_object_date_idx'),
+        ]
+
+    actor_name = Action.actor_name
+    __unicode__ = Action.__unicode__
+    __str__ = Action.__str__
+
+    @classmethod
+    def from_action(cls, action):
+        """ The archive of an action
+
+        :param action: the action to archive
+        :type action: :py:class:`Action`
+        :rtype: an unsaved :py:class:`ArchivedAction`
+        """
+        return cls(id=action.pk, actor_id=action.actor_id,
+            process_date=action.process_date,
+            transition_id=action.transition_id,
+            previous_state_id=action.previous_state_id,
+            workflow_id=action.workflow_id,
+            creation_date=action.creation_date,
+            content_type_id=action.content_type_id,
+            object_id=action.object_id)
+
+
+def _live_receivers(signal, sender):
+    """ The synchronous receivers of a signal for a sender, in the order
+    ``Signal.send`` calls them """
+    receivers = signal._live_receivers(sender)
+    # Django 5.0 returns the synchronous and asynchronous receivers apart
+    if isinstance(receivers, tuple):
+        receivers = receivers[0]
+    return receivers
+
+
+def send_robust(signal, name, atomic=False, **named):
+    """ Send a signal to all its receivers, measure the time spent in them
+    and report the exceptions they raised
+
+    :param signal: the signal to send
+    :type signal: `django.dispatch.Signal <https://docs.djangoproject.com/en/dev/topics/signals/>`_
+    :param name: the name of the signal in the metrics
+    :type name: a string
+    :param atomic: run each receiver in its own savepoint, so that a
+        receiver failing on a database error inside a transaction only rolls
+        back its own changes
+    :type atomic: a boolean
+    :return: the receivers and their responses
+    :rtype: a list of tuples
+    """
+    metrics = get_metrics()
+    start = time.perf_counter()
+    if atomic:
+        responses = []
+        for listener in _live_receivers(signal, named['sender']):
+            try:
+                with transaction.atomic():
+                    response = listener(signal=signal, **named)
+            except Exception as err:
+                response = err
+            responses.append((listener, response))
+    else:
+        responses = signal.send_robust(**named)
+    metrics.observe('workflow_activity_receivers_seconds',
+        time.perf_counter() - start, signal=name)
+    for listener, response in responses:
+        if isinstance(response, Exception):
+            receiver_name = '{0}.{1}'.format(
+                getattr(listener, '__module__', ''),
+                getattr(listener, '__qualname__', repr(listener)))
+            metrics.increment('workflow_activity_receiver_errors_total',
+                signal=name, receiver=receiver_name)
+            logger.error('Receiver %s of %s failed', receiver_name, name,
+                exc_info=(type(response), response, response.__traceback__))
+    return responses
+
+
+class StateDuration(models.Model):
+    """ Rollup of the stays of the workflow managed instances in a state,
+    added by :py:meth:`update` for the new actions. It is kept when the
+    actions are archived. ::
+
+    .. py:attribute:: action_id
+
+        The identifier of the action that ended the stay
+
+    .. py:attribute:: seconds
+
+        The duration of the stay
+    """
+
+    action_id = models.IntegerField(unique=True)
+    workflow = models.ForeignKey('workflows.Workflow',
+            verbose_name=_('Workflow'), related_name='+', on_delete=models.CASCADE)
+    state = models.ForeignKey('workflows.State',
+            verbose_name=_('State'), related_name='+', on_delete=models.CASCADE)
+    content_type = models.ForeignKey(ContentType, related_name='+',
+            on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    entered_date = models.DateTimeField(verbose_name=_('Date of entry'))
+    left_date = models.DateTimeField(verbose_name=_('Date of exit'))
+    seconds = models.FloatField(verbose_name=_('Duration'))
+
+    objects = managers.StateDurationQuerySet.as_manager()
+
+
+    class Meta:
+        verbose_name = _('State duration')
+        verbose_name_plural = _('State durations')
+        app_label = 'workflow_activity'
+        indexes = [
+            models.Index(fields=['workflow', 'state', 'seconds'],
+                name='wfa_duration_state_idx'),
+            # last stay of the rollup
+            models.Index(fields=['-left_date'],
+                name='wfa_duration_left_date_idx'),
+        ]
+
+    #: the longest expected transaction: the actions are dated when they
+    #: are created and can be committed after later actions, the rollup
+    #: reads again the actions of this period before its last stay
+    safety_margin = datetime.timedelta(hours=1)
+
+    @classmethod
+    def update(cls, using='default'):
+        """ Add the stays ended by the actions created since the last update,
+        with a single ``INSERT ... SELECT`` that pairs the new actions with
+        the previous ones in the database. The actions dated from
+        :py:attr:`safety_margin` before the last stay are read again and
+        the stays that are not rolled up yet are added, so that the actions
+        committed late are not missed
+
+        :param using: the alias of the database
+        :type using: a string
+        :return: the number of stays added
+        :rtype: an integer
+        """
+        last_date = cls.objects.using(using).aggregate(
+            last=models.Max('left_date'))['last']
+        connection = connections[using]
+        table = connection.ops.quote_name(cls._meta.db_table)
+        actions = Action.objects.using(using)
+        conditions = ['NOT EXISTS (SELECT 1 FROM {0} r WHERE r.{1} = '
+            's.action_id)'.format(table, connection.ops.quote_name(
+                'action_id'))]
+        since_params = ()
+        if last_date is not None:
+            since = last_date - cls.safety_margin
+            # the previous actions of the instances are needed to pair the
+            # new ones
+            actions = actions.filter(models.Exists(Action.objects.filter(
+                process_date__gte=since,
+                content_type=models.OuterRef('content_type'),
+                object_id=models.OuterRef('object_id'))))
+            conditions.append('s.left_date >= %s')
+            since_params = (connection.ops.adapt_datetimefield_value(since), )
+        sql, params = actions.durations_sql()
+        columns = ', '.join(connection.ops.quote_name(column) for column in
+            ('action_id', 'workflow_id', 'state_id', 'content_type_id',
+            'object_id', 'entered_date', 'left_date', 'seconds'))
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute('INSERT INTO {0} ({1}) SELECT {1} FROM ({2}) s '
+                'WHERE {3}'.format(table, columns, sql,
+                    ' AND '.join(conditions)), params + since_params)
+            return cursor.rowcount
+
+
+class StateCounter(models.Model):
+    """ Number of workflow managed instances in each state, maintained in
+    the transactions of :py:meth:`WorkflowManagedInstance.change_state`,
+    :py:meth:`WorkflowManagedInstance.set_workflow` and
+    :py:meth:`WorkflowManagedInstance.remove_workflow`. The states set by
+    another way are counted again by :py:meth:`rebuild`. ::
+
+    .. py:attribute:: count
+
+        The number of instances of the content type in the state
+    """
+
+    content_type = models.ForeignKey(ContentType, related_name='+',
+            on_delete=models.CASCADE)
+    workflow = models.ForeignKey('workflows.Workflow',
+            verbose_name=_('Workflow'), related_name='+', on_delete=models.CASCADE)
+    state = models.ForeignKey('workflows.State',
+            verbose_name=_('State'), related_name='+', on_delete=models.CASCADE)
+    count = models.IntegerField(verbose_name=_('Count'), default=0)
+
+
+    class Meta:
+        verbose_name = _('State counter')
+        verbose_name_plural = _('State counters')
+        app_label = 'workflow_activity'
+        unique_together = (('content_type', 'workflow', 'state'), )
+
+    @classmethod
+    def add(cls, content_type, state, delta, using=None):
+        """ Add a number of instances to the counter of a state, in the
+        current transaction
+
+        :param content_type: the content type of the instances
+        :type content_type: a content type
+        :param state: the state
+        :type state: `workflows.models.State <http://packages.python.org/django-workflows/api.html#workflows.models.State>`_
+        :param delta: the number of instances entering the state, negative
+            when they leave it
+        :type delta: an integer
+
+        A missing counter is created only for the instances entering the
+        state, the counters that drifted are fixed by :py:meth:`rebuild`.
+        """
+        if state is None or not delta:
+            return
+        counters = cls.objects.using(using).filter(content_type=content_type,
+            workflow_id=state.workflow_id, state=state)
+        if counters.update(count=models.F('count') + delta) or delta < 0:
+            return
+        try:
+            with transaction.atomic(using=using):
+                cls.objects.using(using).create(content_type=content_type,
+                    workflow_id=state.workflow_id, state=state, count=delta)
+        except IntegrityError:
+            # created by a concurrent transaction
+            counters.update(count=models.F('count') + delta)
+
+    @classmethod
+    def move(cls, content_type, source, destination, delta=1, using=None):
+        """ Move a number of instances from the counter of a state to the
+        counter of another one, with a single query when both counters exist
+
+        :param content_type: the content type of the instances
+        :type content_type: a content type
+        :param source: the state left by the instances, as read from the
+            relations that were updated rather than from a cache
+        :type source: `workflows.models.State <http://packages.python.org/django-workflows/api.html#workflows.models.State>`_
+        :param destination: the state entered by the instances
+        :type destination: `workflows.models.State <http://packages.python.org/django-workflows/api.html#workflows.models.State>`_
+        :param delta: the number of instances
+        :type delta: an integer
+        """
+        if source is None:
+            return cls.add(content_type, destination, delta, using)
+        if source == destination or not delta:
+            return
+        counters = cls.objects.using(using).filter(content_type=content_type,
+            workflow_id__in=set([source.workflow_id,
+                destination.workflow_id]),
+            state__in=[source, destination])
+        updated = counters.update(count=models.F('count') + models.Case(
+            models.When(state=destination, then=delta), default=-delta))
+        if updated < 2 and not counters.filter(state=destination).exists():
+            cls.add(content_type, destination, delta, using)
+
+    @classmethod
+    def rebuild(cls, using='default'):
+        """ Count again the instances of the workflow managed models in each
+        state. The states changed by other transactions while it runs may be
+        missed, run it when the counters drifted
+
+        :param using: the alias of the database
+        :type using: a string
+        :return: the number of counters that were wrong
+        :rtype: an integer
+        """
+        ctypes = ContentType.objects.db_manager(using).get_for_models(*[
+            model for model in apps.get_models()
+            if issubclass(model, WorkflowManagedInstance)
+        ]).values()
+        with transaction.atomic(using=using):
+            counters = cls.objects.using(using)
+            previous = dict(((counter.content_type_id, counter.workflow_id,
+                    counter.state_id), counter.count)
+                for counter in counters.select_for_update())
+            counts = dict(((row['content_type'], row['state__workflow'],
+                    row['state']), row['count'])
+                for row in workflows.models.StateObjectRelation.objects
+                    .using(using).filter(content_type__in=ctypes)
+                    .values('content_type', 'state__workflow', 'state')
+                    .annotate(count=models.Count('pk')).order_by())
+            counters.all().delete()
+            counters.bulk_create([cls(content_type_id=ctype_id,
+                    workflow_id=workflow_id, state_id=state_id, count=count)
+                for (ctype_id, workflow_id, state_id), count
+                in counts.items()])
+        return len([key for key in set(previous) | set(counts)
+            if previous.get(key, 0) != counts.get(key, 0)])
+
+
 class WorkflowManagedInstance(models.Model):
     """ Abstract model that must be inherited by models you want to manage an
     history with actions, change and get states easily on instance, get edit
@@ -167,31 +535,323 @@ class WorkflowManagedInstance(models.Model):
 
 
     @property
+    @operation('state')
     def state(self):
         """ Get the state in workflow for the instance of the workflow managed
         model
 
+        :return: the state of the managed instance
+        :rtype: `workflows.models.State <http://packages.python.org/django-workflows/api.html#workflows.models.State>`_
+
+        The state is cached on the instance after the first access. The cache
+        is updated by :py:meth:`change_state`, :py:meth:`set_workflow` and
+        :py:meth:`remove_workflow`, use :py:meth:`refresh_state` if the state
+        was changed by another way.
+        """
+        try:
+            return self._workflow_state_cache
+        except AttributeError:
+            pass
+
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'state_relation' in prefetched:
+            # the states were resolved by BaseQuerySet.with_state
+            relations = list(prefetched['state_relation'])
+            self._workflow_state_cache = \
+                relations[0].state if relations else None
+        else:
+            self._workflow_state_cache = self._fetch_state()
+        return self._workflow_state_cache
+
+    async def astate(self):
+        """ Async version of :py:attr:`state`
+
         :return: the state of the managed instance
         :rtype: `workflows.models.State <http://packages.python.org/django-workflows/api.html#workflows.models.State>`_
         """
-        return get_state(self)
+        try:
+            return self._workflow_state_cache
+        except AttributeError:
+            pass
+        return await sync_to_async(lambda: self.state)()
 
-    def change_state(self, transition, actor):
+    def state_at(self, timestamp):
+        """ The state of the instance at a given moment, reconstructed from
+        its actions and its archived actions
+
+        :param timestamp: the moment
+        :type timestamp: a datetime
+        :return: the state at this moment, ``None`` if the instance was not
+            created yet
+        :rtype: `workflows.models.State <http://packages.python.org/django-workflows/api.html#workflows.models.State>`_
+        """
+        if self.creation_date and self.creation_date > timestamp:
+            return None
+        return workflows.models.State.objects.filter(
+            pk=managers.state_at_expression(type(self), self.pk, timestamp)
+        ).first()
+
+    def refresh_state(self):
+        """ Reload the state of the instance from the database. The
+        permissions resolved for the previous state are forgotten
+
+        :return: the state of the managed instance
+        :rtype: `workflows.models.State <http://packages.python.org/django-workflows/api.html#workflows.models.State>`_
+        """
+        self._invalidate_state()
+        self._workflow_state_cache = self._fetch_state()
+        return self._workflow_state_cache
+
+    def refresh_from_db(self, *args, **kwargs):
+        """ Reload the instance from the database and forget its cached
+        state, permissions and actions """
+        super(WorkflowManagedInstance, self).refresh_from_db(*args, **kwargs)
+        self._invalidate_state()
+        self.__dict__.pop('_last_actions', None)
+
+    def _fetch_state(self):
+        """ Read the state of the instance and its relation with a single
+        query """
+        relation = workflows.models.StateObjectRelation.objects.filter(
+            content_type=ContentType.objects.get_for_model(self),
+            content_id=self.pk).select_related('state').first()
+        return relation.state if relation else None
+
+    def _invalidate_state(self):
+        """ Forget the cached and prefetched state of the instance and the
+        permissions that depend on it """
+        self.__dict__.pop('_workflow_state_cache', None)
+        self.__dict__.pop('_permissions_cache', None)
+        getattr(self, '_prefetched_objects_cache', {}).pop(
+            'state_relation', None)
+
+    @operation('change_state')
+    def change_state(self, transition, actor, optimistic=False, retries=0):
         """ Set new state for the instance of the workflow managed model
 
         :param transition: a transition object
         :type transition: `workflows.models.Transition <http://packages.python.org/django-workflows/api.html#workflows.models.Transition>`_
-        :param actor: a user object
+        :param actor: a user object, ``None`` for an automatic transition
         :type actor: `django.contrib.auth.User <https://docs.djangoproject.com/en/1.4/topics/auth/#users>`_
+        :param optimistic: change the state only if it is still the state
+            read by the instance
+        :type optimistic: a boolean
+        :param retries: the number of times the transition is tried again
+            from the new state of the instance after a conflict, if the actor
+            can still execute it (without permission for an automatic
+            transition)
+        :type retries: an integer
+        :raises StateConflict: in optimistic mode, when the transition does
+            not leave the state read by the instance, or when the state was
+            changed by another transaction (and the transition cannot be
+            executed from the new state after the retries)
 
         This method send a signal to the application to notify a managed
         instance is changing state. The signal provides several arguments as
         the previous state, the executed transition and the actor.
+
+        The state, the permissions, the counters and the action are written
+        in a single transaction, with a conditional ``UPDATE`` from the state
+        cached by the instance. When another transaction changed the state
+        first, the state is locked and read again, or nothing is written in
+        optimistic mode. Only the optimistic mode checks that the transition
+        leaves the state, the default mode executes it from any state. The
+        receivers of the signal run in the transaction, each in its own
+        savepoint so that a receiver failing on a database error does not
+        break it. See the README for the number of statements of a
+        transition.
+        """
+        start = time.perf_counter()
+        ctype = ContentType.objects.get_for_model(self)
+        metrics = get_metrics()
+        labels = self._transition_labels(transition)
+        while True:
+            expected_state = self.state
+            if optimistic and not self._leaves(transition, expected_state):
+                raise StateConflict(self, expected_state, transition)
+            with transaction.atomic():
+                changed, previous_state = self._write_state(ctype,
+                    transition, optimistic)
+                if changed:
+                    self._invalidate_state()
+                    self._workflow_state_cache = transition.destination
+                    self.__dict__.pop('_last_actions', None)
+                    send_robust(changed_state, 'changed_state', atomic=True,
+                        sender=self, transition=transition, actor=actor,
+                        previous_state=previous_state)
+            if changed:
+                break
+
+            metrics.increment('workflow_activity_state_conflicts_total',
+                **labels)
+            self.refresh_state()
+            if retries <= 0:
+                raise StateConflict(self, expected_state, transition)
+            if actor is None:
+                # an automatic transition requires no permission, its
+                # source state is checked by the next try
+                allowed = transition
+            else:
+                allowed = self.allowed_transition(transition.pk, actor)
+                if allowed is None:
+                    raise StateConflict(self, expected_state, transition)
+            retries -= 1
+            transition = allowed
+
+        metrics.increment('workflow_activity_transitions_total', **labels)
+        metrics.observe('workflow_activity_change_state_seconds',
+            time.perf_counter() - start, **labels)
+
+    def _write_state(self, ctype, transition, optimistic):
+        """ Write the destination of a transition as the state of the
+        instance, its permissions and the counters of the states
+
+        :return: whether the state was written, and the state it replaced
+        :rtype: a tuple
         """
-        actual_state = self.state
-        set_state(self, transition.destination)
-        changed_state.send_robust(sender=self, transition=transition,
-                actor=actor, previous_state=actual_state)
+        expected_state = self.state
+        relations = workflows.models.StateObjectRelation.objects.filter(
+            content_type=ctype, content_id=self.pk)
+        if expected_state is not None and relations.filter(
+                state=expected_state).update(state=transition.destination):
+            previous_state = expected_state
+        elif optimistic:
+            return False, expected_state
+        else:
+            # the state changed since it was read
+            relation = relations.select_for_update().select_related(
+                'state').first()
+            if relation is None:
+                previous_state = None
+                workflows.models.StateObjectRelation.objects.create(
+                    content_type=ctype, content_id=self.pk,
+                    state=transition.destination)
+            else:
+                previous_state = relation.state
+                relations.update(state=transition.destination)
+
+        update_permissions_for_objects(ctype, [self.pk],
+            transition.destination)
+        StateCounter.move(ctype, previous_state, transition.destination)
+        return True, previous_state
+
+    @staticmethod
+    def _leaves(transition, state):
+        """ Does the transition leave the state, read from the compiled graph
+        """
+        return state is not None and transition.pk in get_workflow_graph(
+            state.workflow_id).transitions.get(state.pk, {})
+
+    @classmethod
+    def _transition_labels(cls, transition):
+        """ The labels of the metrics of a transition, read without query """
+        opts = cls._meta.concrete_model._meta
+        return {
+            'workflow': transition.workflow_id,
+            'transition': transition.name,
+            'content_type': '{0}.{1}'.format(opts.app_label, opts.model_name),
+        }
+
+    async def achange_state(self, transition, actor, optimistic=False,
+            retries=0):
+        """ Async version of :py:meth:`change_state`
+
+        The state, the permissions and the action are written in a single
+        thread hop, as the receivers of the signal and the transactions are
+        synchronous.
+        """
+        await sync_to_async(self.change_state)(transition, actor,
+            optimistic=optimistic, retries=retries)
+
+    @classmethod
+    @operation('bulk_change_state')
+    def bulk_change_state(cls, instances, transition, actor):
+        """ Set new state for many instances of the workflow managed model at
+        once. Only the instances that are currently in a workflow state are
+        changed
+
+        :param instances: the instances to change
+        :type instances: a queryset or an iterable of workflow managed
+            instances
+        :param transition: a transition object
+        :type transition: `workflows.models.Transition <http://packages.python.org/django-workflows/api.html#workflows.models.Transition>`_
+        :param actor: a user object
+        :type actor: `django.contrib.auth.User <https://docs.djangoproject.com/en/1.4/topics/auth/#users>`_
+        :return: the number of instances that changed state
+        :rtype: an integer
+
+        Only the instances in a state the transition leaves are changed, the
+        transition is not checked against the permissions of the actor. The
+        instances are changed by batches of ``BULK_BATCH_SIZE``, with a fixed
+        number of queries per batch and only the primary keys of a queryset
+        are read. Once the states are written, one signal is sent to the
+        application per batch. The signal provides the changed instances
+        (with only their primary key loaded for a queryset), the executed
+        transition, the actor and the previous states of the instances,
+        mapped by primary key.
+        """
+        start = time.perf_counter()
+        ctype = ContentType.objects.get_for_model(cls)
+        pks, instances = cls._bulk_pks(instances)
+        instances = dict((instance.pk, instance) for instance in instances)
+        source_state_ids = [state_id for state_id, transitions in
+            get_workflow_graph(transition.workflow_id).transitions.items()
+            if transition.pk in transitions]
+        relations = workflows.models.StateObjectRelation.objects.filter(
+            content_type=ctype, content_id__in=pks,
+            state__in=source_state_ids).order_by('content_id')
+
+        batches = []
+        with transaction.atomic():
+            states = workflows.models.State.objects.in_bulk(source_state_ids)
+            last_pk = None
+            while True:
+                batch = relations if last_pk is None \
+                    else relations.filter(content_id__gt=last_pk)
+                previous_state_ids = dict(batch.select_for_update()
+                    .values_list('content_id', 'state')[:BULK_BATCH_SIZE])
+                if not previous_state_ids:
+                    break
+                last_pk = max(previous_state_ids)
+                workflows.models.StateObjectRelation.objects.filter(
+                    content_type=ctype, content_id__in=list(previous_state_ids)
+                ).update(state=transition.destination)
+                for state_id, count in Counter(
+                        previous_state_ids.values()).items():
+                    StateCounter.add(ctype, states[state_id], -count)
+                StateCounter.add(ctype, transition.destination,
+                    len(previous_state_ids))
+                update_permissions_for_objects(ctype,
+                    list(previous_state_ids), transition.destination)
+                batches.append(previous_state_ids)
+                if len(previous_state_ids) < BULK_BATCH_SIZE:
+                    break
+
+        for previous_state_ids in batches:
+            if instances:
+                changed = [instances[pk] for pk in previous_state_ids]
+                for instance in changed:
+                    instance._invalidate_state()
+                    instance._workflow_state_cache = transition.destination
+                    instance.__dict__.pop('_last_actions', None)
+            else:
+                loaded = cls._base_manager.only('pk').in_bulk(
+                    list(previous_state_ids))
+                changed = [loaded[pk] for pk in previous_state_ids
+                    if pk in loaded]
+            send_robust(bulk_changed_state, 'bulk_changed_state', sender=cls,
+                instances=changed, transition=transition, actor=actor,
+                previous_states=dict((pk, states[state_id])
+                    for pk, state_id in previous_state_ids.items()))
+
+        count = sum(len(previous_state_ids) for previous_state_ids in batches)
+        metrics = get_metrics()
+        labels = cls._transition_labels(transition)
+        metrics.increment('workflow_activity_transitions_total', count,
+            **labels)
+        metrics.observe('workflow_activity_bulk_change_state_seconds',
+            time.perf_counter() - start, **labels)
+        return count
 
     @property
     def is_editable(self):
@@ -199,8 +859,9 @@ class WorkflowManagedInstance(models.Model):
         """
         state = self.state
         return state is not None and \
-                state not in get_ending_states(state.workflow)
+            not get_workflow_graph(state.workflow_id).is_ending_state(state.pk)
 
+    @operation('is_editable_by')
     def is_editable_by(self, user, permission='edit'):
         """ Is this managed instance editable by user in fact of state and his
         role permission
@@ -210,8 +871,43 @@ class WorkflowManagedInstance(models.Model):
         :param permission: the permisson to match
         :type permission: a string
         """
-        return self.is_editable and has_permission(self, user, permission)
+        return self.is_editable and self._has_permission(user, permission)
+
+    def _has_permission(self, user, codename):
+        """ Same as ``permissions.utils.has_permission`` but the permissions
+        granted to the user on the instance are resolved once per state and
+        kept on the instance, indexed by user primary key. They are kept
+        until the state of the instance changes or is read again by
+        :py:meth:`refresh_state` or ``refresh_from_db``: the roles and
+        permissions changed in the meantime are not seen, so the instances
+        should live no longer than a request
+        """
+        if user.is_superuser:
+            return True
 
+        cache = self.__dict__.setdefault('_permissions_cache', {})
+        try:
+            granted = cache[user.pk]
+        except KeyError:
+            granted = cache[user.pk] = get_granted_permissions(self, user)
+        if codename in granted:
+            return True
+
+        # permissions may be inherited from a parent object
+        if hasattr(self, 'get_parent_for_permissions'):
+            return has_permission(self, user, codename)
+        return False
+
+    def _can_execute(self, transition, user):
+        """ Has the user the permission required by the transition """
+        permission = transition.permission
+        if permission is None:
+            return True
+        # the instance may define its own permission check
+        check = getattr(self, 'has_permission', self._has_permission)
+        return check(user, permission.codename)
+
+    @operation('allowed_transitions')
     def allowed_transitions(self, user):
         """ Allowed transitions user can do on the managed instance
 
@@ -219,9 +915,78 @@ class WorkflowManagedInstance(models.Model):
         :type user: `django.contrib.auth.User <https://docs.djangoproject.com/en/1.4/topics/auth/#users>`_
         :return: allowed transitions
         :rtype: a list of `workflows.models.Transition <http://packages.python.org/django-workflows/api.html#workflows.models.Transition>`_
+
+        The transitions are read from the compiled graph of the workflow and
+        copied, and the permissions of the user are resolved once per state
+        (see :py:meth:`_has_permission`).
+        """
+        state = self.state
+        if state is None:
+            return []
+        transitions = get_workflow_graph(state.workflow_id).transitions
+        return [copy_transition(transition) for transition in
+            transitions.get(state.pk, {}).values()
+            if self._can_execute(transition, user)]
+
+    async def aallowed_transitions(self, user):
+        """ Async version of :py:meth:`allowed_transitions`
+
+        The transitions are computed without leaving the event loop when the
+        state, the workflow graph and the permissions of the user are already
+        known by the instance, so only the first call hits the database.
         """
-        return get_allowed_transitions(self, user)
+        state = await self.astate()
+        if state is None:
+            return []
+        resolved = state.workflow_id in _WORKFLOW_GRAPHS and (
+            user.is_superuser
+            or user.pk in self.__dict__.get('_permissions_cache', {})
+        ) and not hasattr(self, 'has_permission') \
+            and not hasattr(self, 'get_parent_for_permissions')
+        if resolved:
+            return self.allowed_transitions(user)
+        return await sync_to_async(self.allowed_transitions)(user)
+
+    @classmethod
+    @operation('allowed_transitions_bulk')
+    def allowed_transitions_bulk(cls, instances, user):
+        """ Allowed transitions user can do on many managed instances
+
+        :param instances: the managed instances
+        :type instances: an iterable of workflow managed instances
+        :param user: a user object
+        :type user: `django.contrib.auth.User <https://docs.djangoproject.com/en/1.4/topics/auth/#users>`_
+        :return: allowed transitions indexed by primary key of instance
+        :rtype: a dict of lists of `workflows.models.Transition <http://packages.python.org/django-workflows/api.html#workflows.models.Transition>`_
 
+        The states of the instances, the roles of the user and the permissions
+        granted to them are fetched with three queries whatever the number of
+        instances. They are also kept on the instances, as if
+        :py:meth:`allowed_transitions` was called on each of them.
+        """
+        instances = list(instances)
+        ctype = ContentType.objects.get_for_model(cls)
+        object_ids = [instance.pk for instance in instances]
+
+        states = dict((relation.content_id, relation.state) for relation in
+            workflows.models.StateObjectRelation.objects.filter(
+                content_type=ctype, content_id__in=object_ids
+            ).select_related('state'))
+        if user.is_superuser:
+            granted = {}
+        else:
+            granted = get_granted_permissions_for_objects(ctype,
+                [pk for pk in object_ids if pk in states], user)
+
+        for instance in instances:
+            instance._invalidate_state()
+            instance._workflow_state_cache = states.get(instance.pk)
+            if instance.pk in granted:
+                instance._permissions_cache = {user.pk: granted[instance.pk]}
+        return dict((instance.pk, instance.allowed_transitions(user))
+            for instance in instances)
+
+    @operation('allowed_transitions')
     def allowed_transition(self, transition_id, user):
         """ Allowed transition on managed instance based on a transition id
         check for the user trying to execute it
@@ -233,18 +998,70 @@ class WorkflowManagedInstance(models.Model):
         :return: the transition if allowed
         :rtype: `workflows.models.Transition <http://packages.python.org/django-workflows/api.html#workflows.models.Transition>`_
         """
-        for transition in self.allowed_transitions(user):
-            if transition.id == transition_id:
-                return transition
+        state = self.state
+        if state is None:
+            return None
+        transition = get_workflow_graph(state.workflow_id).transitions.get(
+            state.pk, {}).get(transition_id)
+        if transition is not None and self._can_execute(transition, user):
+            return copy_transition(transition)
         return None
 
+    @operation('last_action')
     def last_action(self):
         """ Last action on managed instance
 
         :return: the latest action on managed instance
         :rtype: :py:class:`arc.workflow_activity.Action`
+
+        The latest action annotated by
+        :py:meth:`~workflow_activity.managers.BaseQuerySet.with_last_action`
+        is used when available.
+        """
+        try:
+            last_actions = self._last_actions
+        except AttributeError:
+            return self.actions.latest('process_date')
+        if not last_actions:
+            raise Action.DoesNotExist('Action matching query does not exist.')
+        return last_actions[0]
+
+    def history(self, include_archived=False):
+        """ Actions on managed instance
+
+        :param include_archived: add the actions moved to the archive by the
+            ``archive_workflow_activity`` command
+        :type include_archived: a boolean
+        :return: the actions on managed instance, oldest first
+        :rtype: a list of :py:class:`Action` and :py:class:`ArchivedAction`
+        """
+        related = ('actor', 'transition', 'previous_state', 'workflow')
+        actions = list(self.actions.select_related(*related)
+            .order_by('process_date', 'pk'))
+        if include_archived:
+            archived = ArchivedAction.objects.select_related(*related).filter(
+                content_type=ContentType.objects.get_for_model(self),
+                object_id=self.pk).order_by('process_date', 'pk')
+            actions = sorted(list(archived) + actions,
+                key=lambda action: (action.process_date, action.pk))
+        return actions
+
+    async def alast_action(self):
+        """ Async version of :py:meth:`last_action`, the actor, the transition
+        and the previous state are fetched with the action
         """
-        return self.actions.latest('process_date')
+        try:
+            last_actions = self._last_actions
+        except AttributeError:
+            pass
+        else:
+            if not last_actions:
+                raise Action.DoesNotExist(
+                    'Action matching query does not exist.')
+            return last_actions[0]
+        return await sync_to_async(lambda: self.actions.select_related(
+            'actor', 'transition', 'previous_state'
+        ).latest('process_date'))()
 
     def last_actor(self):
         """ Last actor on managed instance
@@ -282,57 +1099,239 @@ class WorkflowManagedInstance(models.Model):
     def set_workflow(self, workflow):
         """ Initiate a workflow for instance. """
         if self.state is None:
-            if not workflow:
-                ctype = ContentType.objects.get_for_model(self)
-                workflow = get_workflow_for_model(ctype)
-            set_workflow_for_object(self, workflow)
+            type(self).bulk_set_workflow([self], workflow)
+
+    @classmethod
+    @operation('bulk_set_workflow')
+    def bulk_set_workflow(cls, instances, workflow=None):
+        """ Initiate a workflow for many instances of the workflow managed
+        model at once. Only the instances that are not in a workflow state
+        are changed, they get the initial state of the workflow
+
+        :param instances: the instances to change
+        :type instances: a queryset or an iterable of workflow managed
+            instances
+        :param workflow: the workflow or its name, the workflow of the model
+            if not given
+        :type workflow: `workflows.models.Workflow <http://packages.python.org/django-workflows/api.html#workflows.models.Workflow>`_
+        :return: the number of instances that got the workflow
+        :rtype: an integer
+
+        The relations are inserted with bulk queries, the number of queries
+        only grows with every ``BULK_BATCH_SIZE`` instances.
+        """
+        ctype = ContentType.objects.get_for_model(cls)
+        if not workflow:
+            workflow = get_workflow_for_model(ctype)
+        elif not isinstance(workflow, workflows.models.Workflow):
+            workflow = workflows.models.Workflow.objects.filter(
+                name=workflow).first()
+        if workflow is None or workflow.initial_state is None:
+            return 0
+        state = workflow.initial_state
+        pks, instances = cls._bulk_pks(instances)
+
+        with transaction.atomic():
+            object_ids = list(cls._base_manager.filter(pk__in=pks).exclude(
+                models.Exists(workflows.models.StateObjectRelation.objects
+                    .filter(content_type=ctype,
+                        content_id=models.OuterRef('pk')))
+            ).values_list('pk', flat=True))
+            for start in range(0, len(object_ids), BULK_BATCH_SIZE):
+                batch = object_ids[start:start + BULK_BATCH_SIZE]
+                workflows.models.WorkflowObjectRelation.objects.filter(
+                    content_type=ctype, content_id__in=batch).delete()
+                workflows.models.WorkflowObjectRelation.objects.bulk_create([
+                    workflows.models.WorkflowObjectRelation(
+                        content_type=ctype, content_id=object_id,
+                        workflow=workflow)
+                    for object_id in batch
+                ])
+                workflows.models.StateObjectRelation.objects.bulk_create([
+                    workflows.models.StateObjectRelation(content_type=ctype,
+                        content_id=object_id, state=state)
+                    for object_id in batch
+                ])
+                update_permissions_for_objects(ctype, batch, state)
+            StateCounter.add(ctype, state, len(object_ids))
+
+        changed = set(object_ids)
+        for instance in instances:
+            if instance.pk in changed:
+                instance._invalidate_state()
+                instance._workflow_state_cache = state
+        return len(object_ids)
+
+    @staticmethod
+    def _bulk_pks(instances):
+        """ The primary keys of instances, as a subquery for a queryset
+
+        :return: the primary keys and the instances to update
+        :rtype: a tuple
+        """
+        if isinstance(instances, models.QuerySet):
+            return instances.values('pk'), []
+        instances = list(instances)
+        return [instance.pk for instance in instances], instances
+
+    @classmethod
+    def counts_by_state(cls, workflow=None):
+        """ Number of instances in each state, read from the
+        :py:class:`StateCounter` table with a single query
+
+        :param workflow: the workflow of the states, all if not given
+        :type workflow: `workflows.models.Workflow <http://packages.python.org/django-workflows/api.html#workflows.models.Workflow>`_
+        :return: the number of instances, indexed by state
+        :rtype: a dict
+        """
+        counters = StateCounter.objects.filter(
+            content_type=ContentType.objects.get_for_model(cls),
+        ).select_related('state')
+        if workflow is not None:
+            counters = counters.filter(workflow=workflow)
+        return dict((counter.state, counter.count) for counter in counters)
 
     def remove_workflow(self):
         """ Remove entirely a worflow for an instance. """
-
-        ctype = ContentType.objects.get_for_model(self)
-        try:
-            workflow = self.state.workflow
-            wor = workflows.models.WorkflowObjectRelation.objects.get(
-                content_type=ctype, content_id=self.pk
-            )
-            sor = workflows.models.StateObjectRelation.objects.get(
-                content_type=ctype, content_id=self.pk
-            )
-        except workflows.models.WorkflowObjectRelation.DoesNotExist:
-            pass
-        except workflows.models.StateObjectRelation.DoesNotExist:
-            pass
+        type(self).bulk_remove_workflow([self])
+
+    @classmethod
+    @operation('bulk_remove_workflow')
+    def bulk_remove_workflow(cls, instances):
+        """ Remove entirely the workflow of many instances of the workflow
+        managed model at once
+
+        :param instances: the instances to change
+        :type instances: a queryset or an iterable of workflow managed
+            instances
+        :return: the number of instances that were in a workflow state
+        :rtype: an integer
+
+        The relations are deleted with a fixed number of queries, whatever
+        the number of instances.
+        """
+        ctype = ContentType.objects.get_for_model(cls)
+        pks, instances = cls._bulk_pks(instances)
+        states = workflows.models.StateObjectRelation.objects.filter(
+            content_type=ctype, content_id__in=pks)
 
         with transaction.atomic():
-            wor.delete()
-            sor.delete()
+            counts = dict(states.values_list('state')
+                .annotate(count=models.Count('pk')).order_by())
+            workflows.models.WorkflowObjectRelation.objects.filter(
+                content_type=ctype, content_id__in=pks).delete()
+            states.delete()
+            for state in workflows.models.State.objects.filter(
+                    pk__in=list(counts)):
+                StateCounter.add(ctype, state, -counts[state.pk])
+
+        for instance in instances:
+            instance._invalidate_state()
+            instance._workflow_state_cache = None
+        return sum(counts.values())
 
 
-@receiver(m2m_changed, sender=workflows.models.State.transitions.through)
 @receiver(post_save, sender=workflows.models.State)
-def update_ending_states(sender, **kwargs):
-    """ When new states are created or new transitions are added to states, the
-    ENDING_STATES static variable must be updated
+@receiver(post_delete, sender=workflows.models.State)
+@receiver(post_save, sender=workflows.models.Transition)
+@receiver(post_delete, sender=workflows.models.Transition)
+def update_workflow_graph(sender, instance, **kwargs):
+    """ When states or transitions are saved or deleted, the compiled graph of
+    their workflow must be rebuilt
+
+    :param sender: the model that send the signal
+    :param instance: the saved or deleted state or transition
+    """
+    invalidate_workflow_graph(instance.workflow_id)
+
+
+@receiver(post_save, sender=workflows.models.Workflow)
+@receiver(post_delete, sender=workflows.models.Workflow)
+def update_workflow_ids(sender, **kwargs):
+    """ When workflows are created or deleted, the primary keys of the
+    workflows kept in memory must be reloaded
+
+    :param sender: the model that send the signal
+    """
+    if kwargs.get('created', True):
+        invalidate_workflow_ids()
+
+
+@receiver(post_save, sender=permissions.models.Permission)
+def update_workflow_graph_permissions(sender, instance, created, **kwargs):
+    """ The compiled graphs hold the permissions of the transitions, the
+    graphs of the workflows whose transitions require a permission must be
+    rebuilt when it is changed
 
     :param sender: the model that send the signal
+    :param instance: the permission
+    :param created: is the permission new, so that no transition requires
+        it yet
+    """
+    if created:
+        return
+    for workflow_id in set(workflows.models.Transition.objects.filter(
+            permission=instance).values_list('workflow_id', flat=True)):
+        invalidate_workflow_graph(workflow_id)
+
+
+@receiver(m2m_changed, sender=workflows.models.State.transitions.through)
+def update_workflow_graph_transitions(sender, instance, action, reverse,
+        **kwargs):
+    """ When transitions are added to or removed from states, the compiled
+    graph of the workflow must be rebuilt
+
+    :param sender: the intermediate model between states and transitions
+    :param instance: the state (or the transition when the relation is
+        changed from the transition side)
+    """
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            invalidate_workflow_graph(instance.workflow_id)
+        elif kwargs['pk_set']:
+            for workflow_id in set(workflows.models.State.objects.filter(
+                    pk__in=kwargs['pk_set']).values_list(
+                        'workflow_id', flat=True)):
+                invalidate_workflow_graph(workflow_id)
+        else:
+            # the cleared states may belong to any workflow
+            invalidate_workflow_graph()
+
+
+@receiver(request_started)
+def check_workflow_graphs(sender, **kwargs):
+    """ At the beginning of each request, the compiled graphs of the workflows
+    changed by other processes are forgotten. Outside of the requests, they
+    are revalidated by :py:func:`~workflow_activity.utils.get_workflow_graph`
+    at regular intervals
     """
-    # signal send when a state is saved
-    is_new_state = sender == workflows.models.State and kwargs['created']
-    # signal send when transitions are added to a state
-    transition_added = sender == workflows.models.State.transitions.through \
-        and kwargs['action'] == 'post_add'
+    revalidate_workflow_graphs()
 
-    if is_new_state or transition_added:
-        from . import _ENDING_STATES
-        workflow = kwargs['instance'].workflow
-        # update the value for the right workflow in the static variable
-        if workflow.name in _ENDING_STATES:
-            del _ENDING_STATES[workflow.name]
-            _ENDING_STATES[workflow.name] = get_ending_states(workflow)
+
+def buffer_actions(actions):
+    """ Defer the creation of actions to the end of the current transaction
+    when the ``WORKFLOW_ACTIVITY_BUFFER_ACTIONS`` setting is enabled. The
+    actions are saved with a single query by their own
+    ``transaction.on_commit`` hook, that Django drops with the savepoint if
+    it is rolled back
+
+    :param actions: the unsaved actions
+    :type actions: a list of :py:class:`~workflow_activity.models.Action`
+    :return: if the actions were buffered, else they must be saved now
+    :rtype: a boolean
+    """
+    connection = transaction.get_connection()
+    if getattr(settings, 'WORKFLOW_ACTIVITY_BUFFER_ACTIONS', False) \
+            and connection.in_atomic_block:
+        transaction.on_commit(functools.partial(
+            Action.objects.using(connection.alias).bulk_create, actions),
+            using=connection.alias)
+        return True
+    return False
 
 
 @receiver(changed_state)
+@operation('create_action')
 def create_action(sender, **kwargs):
     """ When a workflow managed instance is changing state, this function
     receive the signal and create a new action for the instance. Only model
@@ -342,6 +1341,33 @@ def create_action(sender, **kwargs):
     """
     managed_instance = sender
     if managed_instance.__class__.__base__ == WorkflowManagedInstance:
-        managed_instance.actions.create(transition=kwargs['transition'],
-            actor=kwargs['actor'], previous_state=kwargs['previous_state'],
-            workflow=kwargs['previous_state'].workflow)
+        action = Action(content_object=managed_instance,
+            transition=kwargs['transition'], actor=kwargs['actor'],
+            previous_state=kwargs['previous_state'],
+            workflow_id=kwargs['previous_state'].workflow_id)
+        if not buffer_actions([action]):
+            action.save()
+
+
+@receiver(bulk_changed_state)
+@operation('create_action')
+def create_actions(sender, **kwargs):
+    """ When many workflow managed instances are changing state at once, this
+    function receive the signal and create all the new actions with a single
+    query. Only models that inherits WorkflowManagedInstance will be matched to
+    create actions
+
+    :param sender: the model of the instances that send the signal
+    """
+    if sender.__base__ == WorkflowManagedInstance:
+        ctype = ContentType.objects.get_for_model(sender)
+        previous_states = kwargs['previous_states']
+        actions = [
+            Action(content_type=ctype, object_id=instance.pk,
+                transition=kwargs['transition'], actor=kwargs['actor'],
+                previous_state=previous_states[instance.pk],
+                workflow_id=previous_states[instance.pk].workflow_id)
+            for instance in kwargs['instances']
+        ]
+        if not buffer_actions(actions):
+            Action.objects.bulk_create(actions)
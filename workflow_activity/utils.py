@@ -8,7 +8,279 @@ Utility functions for the workflow_activity application that can be used in the
 workflows application.
 """
 
-from . import _ENDING_STATES
+import asyncio
+from collections import namedtuple
+import copy
+import time
+from types import MappingProxyType
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+from django.db import connections
+from django.db import transaction
+from django.contrib.contenttypes.models import ContentType
+from permissions.models import ObjectPermission
+from permissions.models import ObjectPermissionInheritanceBlock
+from permissions.models import PrincipalRoleRelation
+from workflows.models import State
+from workflows.models import StateInheritanceBlock
+from workflows.models import StatePermissionRelation
+from workflows.models import Workflow
+from workflows.models import WorkflowPermissionRelation
+from permissions.utils import get_roles
+
+from . import _WORKFLOW_CATALOG
+from . import _WORKFLOW_GRAPHS
+from . import _WORKFLOW_REVALIDATION
+
+
+class WorkflowGraph(namedtuple('WorkflowGraph',
+        ['workflow_id', 'state_ids', 'ending_state_ids', 'transitions',
+         'generation'])):
+    """ Compiled and immutable view of the states and transitions of a
+    workflow. ::
+
+    .. py:attribute:: workflow_id
+
+        The primary key of the workflow
+
+    .. py:attribute:: state_ids
+
+        The primary keys of the states of the workflow, as a frozenset
+
+    .. py:attribute:: ending_state_ids
+
+        The primary keys of the states without transitions, as a frozenset
+
+    .. py:attribute:: transitions
+
+        The transitions of each state, as a read-only mapping of transitions
+        indexed by their primary keys, indexed by state primary key. The
+        transitions come with their permission and destination, they are
+        shared by the whole process and must not be modified: use
+        :py:func:`copy_transition` before handing them out
+
+    .. py:attribute:: generation
+
+        The generation of the workflow in the shared cache when the graph was
+        built
+    """
+    __slots__ = ()
+
+    def is_ending_state(self, state_id):
+        """ Is the state an ending state of the workflow
+
+        :param state_id: the primary key of the state
+        :type state_id: an integer
+        """
+        return state_id in self.ending_state_ids
+
+    def transition_ids(self, state_id):
+        """ The primary keys of the transitions of a state
+
+        :param state_id: the primary key of the state
+        :type state_id: an integer
+        :rtype: a frozenset
+        """
+        return frozenset(self.transitions.get(state_id, ()))
+
+
+def compile_workflow_graph(workflow_id, generation=None):
+    """ Builds the graph of a workflow from the database
+
+    :param workflow_id: the primary key of the workflow
+    :type workflow_id: an integer
+    :param generation: the generation of the workflow in the shared cache
+    :rtype: :py:class:`~workflow_activity.utils.WorkflowGraph`
+    """
+    transitions = dict((state_id, {}) for state_id in
+        State.objects.filter(workflow_id=workflow_id).order_by()
+            .values_list('pk', flat=True))
+    for relation in State.transitions.through.objects.filter(
+            state__workflow_id=workflow_id).select_related(
+                'transition__permission', 'transition__destination'
+            ).order_by('transition_id'):
+        transitions[relation.state_id][relation.transition_id] = \
+            relation.transition
+
+    return WorkflowGraph(
+        workflow_id=workflow_id,
+        state_ids=frozenset(transitions),
+        ending_state_ids=frozenset(state_id for state_id, transition_ids in
+            transitions.items() if not transition_ids),
+        transitions=MappingProxyType(dict((state_id,
+            MappingProxyType(state_transitions)) for state_id,
+            state_transitions in transitions.items())),
+        generation=generation,
+    )
+
+
+def copy_transition(transition):
+    """ Copy of a transition of a compiled graph, with copies of its
+    permission and destination, that the caller may modify
+
+    :param transition: a transition of a compiled graph
+    :type transition: `workflows.models.Transition <http://packages.python.org/django-workflows/api.html#workflows.models.Transition>`_
+    :rtype: `workflows.models.Transition <http://packages.python.org/django-workflows/api.html#workflows.models.Transition>`_
+    """
+    return copy.deepcopy(transition)
+
+
+def _get_cache():
+    return caches[getattr(settings, 'WORKFLOW_ACTIVITY_CACHE', 'default')]
+
+
+def _generation_key(workflow_id):
+    return 'workflow_activity:graph:{0}'.format(workflow_id)
+
+
+_CATALOG_KEY = 'workflow_activity:workflows'
+
+
+def get_workflow_graph(workflow):
+    """ Get the compiled graph of a workflow. The graph is built once and kept
+    in memory until the states or transitions of the workflow change, in this
+    process or in another one (see :py:func:`revalidate_workflow_graphs`)
+
+    :param workflow: a workflow or its primary key
+    :type workflow: `workflows.models.Workflow <http://packages.python.org/django-workflows/api.html#workflows.models.Workflow>`_
+    :rtype: :py:class:`~workflow_activity.utils.WorkflowGraph`
+    """
+    workflow_id = getattr(workflow, 'pk', workflow)
+    _revalidate_when_due()
+    try:
+        return _WORKFLOW_GRAPHS[workflow_id]
+    except KeyError:
+        # the generation is read before the database so that a change made
+        # in the meantime is seen by the next revalidation
+        generation = _get_cache().get(_generation_key(workflow_id))
+        graph = _WORKFLOW_GRAPHS[workflow_id] = \
+            compile_workflow_graph(workflow_id, generation)
+        return graph
+
+
+def invalidate_workflow_graph(workflow=None):
+    """ Forget the compiled graph of a workflow in this process and, once the
+    current transaction is committed, in all the other processes sharing the
+    cache defined by the ``WORKFLOW_ACTIVITY_CACHE`` setting (``default`` if
+    not set)
+
+    :param workflow: a workflow or its primary key. If not given, the graphs
+        of all the workflows are forgotten
+    :type workflow: `workflows.models.Workflow <http://packages.python.org/django-workflows/api.html#workflows.models.Workflow>`_
+    """
+    if workflow is None:
+        workflow_ids = set(_WORKFLOW_GRAPHS)
+        workflow_ids.update(Workflow.objects.values_list('pk', flat=True))
+    else:
+        workflow_ids = set([getattr(workflow, 'pk', workflow)])
+
+    def new_generation():
+        for workflow_id in workflow_ids:
+            _WORKFLOW_GRAPHS.pop(workflow_id, None)
+        _get_cache().set_many(dict((_generation_key(workflow_id),
+            uuid.uuid4().hex) for workflow_id in workflow_ids), None)
+
+    for workflow_id in workflow_ids:
+        _WORKFLOW_GRAPHS.pop(workflow_id, None)
+    transaction.on_commit(new_generation)
+
+
+def get_workflow_ids():
+    """ The primary keys of all the workflows. They are kept in memory until a
+    workflow is created or deleted
+
+    :rtype: a frozenset of integers
+    """
+    _revalidate_when_due()
+    try:
+        return _WORKFLOW_CATALOG['workflow_ids'][1]
+    except KeyError:
+        generation = _get_cache().get(_CATALOG_KEY)
+        workflow_ids = frozenset(Workflow.objects.values_list('pk', flat=True))
+        _WORKFLOW_CATALOG['workflow_ids'] = (generation, workflow_ids)
+        return workflow_ids
+
+
+def invalidate_workflow_ids():
+    """ Forget the primary keys of the workflows in this process and, once the
+    current transaction is committed, in all the other processes
+    """
+    def new_generation():
+        _WORKFLOW_CATALOG.pop('workflow_ids', None)
+        _get_cache().set(_CATALOG_KEY, uuid.uuid4().hex, None)
+
+    _WORKFLOW_CATALOG.pop('workflow_ids', None)
+    transaction.on_commit(new_generation)
+
+
+def get_ending_state_ids():
+    """ The primary keys of the ending states of all the workflows
+
+    :rtype: a frozenset of integers
+    """
+    return frozenset().union(*(get_workflow_graph(workflow_id)
+        .ending_state_ids for workflow_id in get_workflow_ids()))
+
+
+def get_pending_state_ids():
+    """ The primary keys of the states with transitions of all the workflows
+
+    :rtype: a frozenset of integers
+    """
+    return frozenset().union(*(get_workflow_graph(workflow_id).state_ids -
+        get_workflow_graph(workflow_id).ending_state_ids
+        for workflow_id in get_workflow_ids()))
+
+
+def workflow_graphs_compiled():
+    """ Are the primary keys and the graphs of all the workflows in memory,
+    so that the state ids can be read without a query
+
+    :rtype: a boolean
+    """
+    catalog = _WORKFLOW_CATALOG.get('workflow_ids')
+    return catalog is not None and \
+        all(workflow_id in _WORKFLOW_GRAPHS for workflow_id in catalog[1])
+
+
+def revalidate_workflow_graphs():
+    """ Forget the compiled graphs whose workflow changed in another process.
+    It costs a single query to the shared cache and is run at the beginning of
+    each request, and by :py:func:`get_workflow_graph` once the
+    ``WORKFLOW_ACTIVITY_REVALIDATE_INTERVAL`` setting (in seconds, 5 if not
+    set) has elapsed since the last run, for the processes serving no
+    requests.
+    """
+    _WORKFLOW_REVALIDATION['due'] = time.monotonic() + getattr(settings,
+        'WORKFLOW_ACTIVITY_REVALIDATE_INTERVAL', 5)
+    workflow_ids = dict((_generation_key(workflow_id), workflow_id)
+        for workflow_id in list(_WORKFLOW_GRAPHS))
+    catalog = _WORKFLOW_CATALOG.get('workflow_ids')
+    if workflow_ids or catalog is not None:
+        generations = _get_cache().get_many(
+            list(workflow_ids) + [_CATALOG_KEY])
+        for key, workflow_id in workflow_ids.items():
+            graph = _WORKFLOW_GRAPHS.get(workflow_id)
+            if graph is not None and graph.generation != generations.get(key):
+                _WORKFLOW_GRAPHS.pop(workflow_id, None)
+        if catalog is not None and \
+                catalog[0] != generations.get(_CATALOG_KEY):
+            _WORKFLOW_CATALOG.pop('workflow_ids', None)
+
+
+def _revalidate_when_due():
+    """ Revalidate the compiled graphs if the interval elapsed. Not from an
+    event loop, where the graphs that are forgotten could not be compiled
+    again """
+    if time.monotonic() < _WORKFLOW_REVALIDATION.get('due', 0):
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        revalidate_workflow_graphs()
 
 
 def get_ending_states(workflow):
@@ -19,10 +291,189 @@ def get_ending_states(workflow):
     :return: a list of states
     :rtype: list of `workflows.models.State <http://packages.python.org/django-workflows/api.html#workflows.models.State>`_
     """
-    ending_states = []
-    if workflow.name in _ENDING_STATES:
-        ending_states = _ENDING_STATES[workflow.name]
-    else:
-        ending_states = workflow.states.filter(transitions__isnull=True)
-        _ENDING_STATES[workflow.name] = ending_states
-    return ending_states
+    return workflow.states.filter(
+        pk__in=get_workflow_graph(workflow).ending_state_ids)
+
+
+def get_granted_permissions(obj, user):
+    """ Searches for the permissions granted to a user on an object through
+    the global, group and local roles of the user
+
+    :param obj: the object
+    :type obj: a Django model instance
+    :param user: a user object
+    :type user: `django.contrib.auth.User <https://docs.djangoproject.com/en/1.4/topics/auth/#users>`_
+    :return: the codenames of the permissions
+    :rtype: a frozenset of strings
+    """
+    if user.is_anonymous:
+        return frozenset()
+    return frozenset(ObjectPermission.objects.filter(
+        content_type=ContentType.objects.get_for_model(obj),
+        content_id=obj.pk, role__in=get_roles(user, obj)
+    ).values_list('permission__codename', flat=True))
+
+
+def get_granted_permissions_for_objects(ctype, object_ids, user):
+    """ Searches for the permissions granted to a user on many objects of the
+    same content type through the global, group and local roles of the user.
+    It issues two queries whatever the number of objects.
+
+    :param ctype: the content type of the objects
+    :type ctype: `django.contrib.contenttypes.models.ContentType`
+    :param object_ids: the identifiers of the objects
+    :type object_ids: list of integers
+    :param user: a user object
+    :type user: `django.contrib.auth.User <https://docs.djangoproject.com/en/1.4/topics/auth/#users>`_
+    :return: the codenames of the permissions of each object
+    :rtype: a dict of frozensets of strings indexed by object identifier
+    """
+    granted = dict((object_id, set()) for object_id in object_ids)
+    if user.is_anonymous or not object_ids:
+        return dict((object_id, frozenset()) for object_id in granted)
+
+    global_roles, local_roles = set(), {}
+    for role_id, content_id in PrincipalRoleRelation.objects.filter(
+            Q(user=user) | Q(group__in=user.groups.all()),
+            Q(content_id=None) | Q(content_type=ctype,
+                content_id__in=object_ids)
+            ).values_list('role_id', 'content_id'):
+        if content_id is None:
+            global_roles.add(role_id)
+        else:
+            local_roles.setdefault(content_id, set()).add(role_id)
+
+    role_ids = global_roles.union(*local_roles.values())
+    if role_ids:
+        for content_id, role_id, codename in \
+                ObjectPermission.objects.filter(content_type=ctype,
+                    content_id__in=object_ids, role_id__in=role_ids
+                ).values_list('content_id', 'role_id', 'permission__codename'):
+            if role_id in global_roles or \
+                    role_id in local_roles.get(content_id, ()):
+                granted[content_id].add(codename)
+    return dict((object_id, frozenset(codenames))
+        for object_id, codenames in granted.items())
+
+
+def update_permissions_for_objects(ctype, object_ids, state):
+    """ Updates the permissions of many objects of the same content type
+    according to their new workflow state. This is the set-based counterpart of
+    ``workflows.utils.update_permissions`` : it issues a fixed number of
+    queries whatever the number of objects.
+
+    :param ctype: the content type of the objects
+    :type ctype: `django.contrib.contenttypes.models.ContentType`
+    :param object_ids: the identifiers of the objects
+    :type object_ids: list of integers
+    :param state: the new state of the objects
+    :type state: `workflows.models.State <http://packages.python.org/django-workflows/api.html#workflows.models.State>`_
+    """
+    workflow_permissions = WorkflowPermissionRelation.objects.filter(
+        workflow_id=state.workflow_id).values('permission')
+
+    # Remove all permissions for the workflow and grant the ones of the state
+    ObjectPermission.objects.filter(content_type=ctype,
+        content_id__in=object_ids,
+        permission__in=workflow_permissions).delete()
+    state_permissions = list(StatePermissionRelation.objects.filter(
+        state=state).values_list('role_id', 'permission_id'))
+    if state_permissions:
+        granted = set(ObjectPermission.objects.filter(content_type=ctype,
+            content_id__in=object_ids).values_list(
+                'content_id', 'role_id', 'permission_id'))
+        ObjectPermission.objects.bulk_create([
+            ObjectPermission(content_type=ctype, content_id=object_id,
+                role_id=role_id, permission_id=permission_id)
+            for role_id, permission_id in state_permissions
+            for object_id in object_ids
+            if (object_id, role_id, permission_id) not in granted
+        ])
+
+    # Replace the inheritance blocks by the ones of the state
+    ObjectPermissionInheritanceBlock.objects.filter(content_type=ctype,
+        content_id__in=object_ids,
+        permission__in=workflow_permissions).delete()
+    state_blocks = list(StateInheritanceBlock.objects.filter(
+        state=state).values_list('permission_id', flat=True))
+    if state_blocks:
+        blocked = set(ObjectPermissionInheritanceBlock.objects.filter(
+            content_type=ctype, content_id__in=object_ids).values_list(
+                'content_id', 'permission_id'))
+        ObjectPermissionInheritanceBlock.objects.bulk_create([
+            ObjectPermissionInheritanceBlock(content_type=ctype,
+                content_id=object_id, permission_id=permission_id)
+            for permission_id in state_blocks
+            for object_id in object_ids
+            if (object_id, permission_id) not in blocked
+        ])
+
+
+# percentiles of the durations computed by default
+PERCENTILES = (50, 90, 99)
+
+
+def seconds_between(connection, end, start):
+    """ SQL of the number of seconds between two datetime columns
+
+    :param connection: the database connection
+    :param end: the SQL of the latest datetime
+    :type end: a string
+    :param start: the SQL of the earliest datetime
+    :type start: a string
+    :rtype: a string
+    """
+    sql, params = connection.ops.subtract_temporals('DateTimeField',
+        (end, []), (start, []))
+    if connection.vendor == 'postgresql':
+        # the difference is an interval
+        return 'EXTRACT(EPOCH FROM {0})'.format(sql)
+    if connection.vendor == 'oracle':
+        # the difference is an interval without epoch
+        return ('(EXTRACT(DAY FROM {0}) * 86400 + EXTRACT(HOUR FROM {0}) * '
+            '3600 + EXTRACT(MINUTE FROM {0}) * 60 + EXTRACT(SECOND FROM {0}))'
+            .format(sql))
+    # the difference is a number of microseconds
+    return '({0}) / 1000000.0'.format(sql)
+
+
+def duration_statistics(sql, params, percentiles=PERCENTILES,
+        using='default'):
+    """ Number, average and percentiles (nearest rank) of durations per state,
+    computed by the database with window functions
+
+    :param sql: a query selecting ``state_id`` and ``seconds`` columns
+    :type sql: a string
+    :param params: the parameters of the query
+    :param percentiles: the percentiles to compute, between 1 and 100
+    :type percentiles: a list of integers
+    :param using: the alias of the database
+    :type using: a string
+    :return: the statistics indexed by state primary key, as dicts with
+        ``count``, ``average`` and ``percentiles`` (indexed by percentile)
+        keys, in seconds
+    :rtype: a dict
+    """
+    percentiles = sorted(set(int(percentile) for percentile in percentiles))
+    # position = ceil(percentile * total / 100), without a division whose
+    # result is not an integer on every database (MySQL, Oracle)
+    ranks = ''.join(' OR (r.position * 100 >= {0} * r.total AND '
+        '(r.position - 1) * 100 < {0} * r.total)'.format(percentile)
+        for percentile in percentiles)
+    statistics = {}
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT r.state_id, r.total, r.average, r.position, r.seconds '
+            'FROM (SELECT s.state_id, s.seconds, ROW_NUMBER() OVER ('
+            'PARTITION BY s.state_id ORDER BY s.seconds) AS position, '
+            'COUNT(*) OVER (PARTITION BY s.state_id) AS total, '
+            'AVG(s.seconds) OVER (PARTITION BY s.state_id) AS average '
+            'FROM ({0}) s) r WHERE r.position = 1{1}'.format(sql, ranks),
+            params)
+        for state_id, count, average, position, seconds in cursor.fetchall():
+            stats = statistics.setdefault(state_id, {'count': count,
+                'average': average, 'percentiles': {}})
+            for percentile in percentiles:
+                if position == (percentile * count + 99) // 100:
+                    stats['percentiles'][percentile] = seconds
+    return statistics